@@ -0,0 +1,87 @@
+# Gunicorn configuration of the production server, run from the repository root:
+#
+#   gunicorn -c gunicorn.conf.py
+#
+# The app is loaded once in the master (preload_app), which also loads the
+# metadata caches and indexes before forking the workers, so that the workers
+# share them copy-on-write instead of each holding their own copy. When the
+# metadata updater publishes a new snapshot, the master loads it and replaces
+# the workers gracefully (as on SIGHUP).
+import gc
+import os
+import signal
+import threading
+import time
+
+wsgi_app = "app:app"
+pythonpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+# Worker processes (by default one per core), each handling requests in threads
+workers = int(os.getenv("GUNICORN_WORKERS", str(os.cpu_count() or 1)))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# Seconds that replaced workers get to finish the requests they are handling
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+accesslog = "-"
+
+# Seconds between checks for a newly published metadata snapshot (0 disables reloading)
+SNAPSHOT_POLL_INTERVAL = float(os.getenv("GUNICORN_SNAPSHOT_POLL_INTERVAL", "30"))
+
+
+def warm_caches(server):
+    """Load the metadata caches in the master, before workers are forked."""
+    import api_utils
+
+    start = time.perf_counter()
+    # Objects frozen for the previous snapshot can be collected again
+    gc.unfreeze()
+    version = api_utils.warm_caches()
+    gc.collect()
+    # Move the loaded objects out of reach of the garbage collector, which
+    # would otherwise write to (and so copy) their shared pages in the workers
+    gc.freeze()
+    server.log.info("Loaded metadata snapshot %s in %.3fs", version, time.perf_counter() - start)
+
+
+def watch_snapshots(server, interval):
+    """Reload the workers gracefully when a new metadata snapshot is published."""
+    import api_utils
+
+    def current():
+        try:
+            return os.readlink(api_utils.snapshot_path / "current")
+        except OSError:
+            return None
+
+    version = current()
+    while True:
+        time.sleep(interval)
+        if current() != version:
+            version = current()
+            server.log.info("Metadata snapshot %s was published, reloading workers", version)
+            os.kill(server.pid, signal.SIGHUP)
+
+
+def when_ready(server):
+    warm_caches(server)
+    if SNAPSHOT_POLL_INTERVAL > 0:
+        threading.Thread(
+            target=watch_snapshots,
+            args=(server, SNAPSHOT_POLL_INTERVAL),
+            name="snapshot-watcher",
+            daemon=True,
+        ).start()
+
+
+def on_reload(server):
+    # Called before the new workers are forked
+    warm_caches(server)
+
+
+def post_worker_init(worker):
+    from app import start_background_services
+
+    start_background_services()
@@ -1,19 +1,422 @@
+import json
 import requests
 import os
+from functools import lru_cache
 from pathlib import Path
-from utils import load_json_from_file
+from flask import (
+    abort,
+    g,
+    has_request_context,
+    request,
+)
+from werkzeug.exceptions import HTTPException
+from cache_utils import (
+    REPRESENTATIONS,
+    CacheEntry,
+    MetadataCache,
+)
+from config import Config
+from file_utils import (
+    FILE_QUERY_PARAMS,
+    FileIndex,
+    browse_files,
+    normalize_dir,
+)
+from matrix_utils import AvailabilityMatrix
+from measure_utils import (
+    MeasureOverview,
+    lookup_measures,
+)
+from search_utils import (
+    SearchIndex,
+    search_measures,
+)
+from snapshot_utils import (
+    current_snapshot,
+    load_snapshot,
+)
+from stats_utils import (
+    STATS_CACHE_SIZE,
+    StatsCube,
+    compute_stats,
+    parse_stats_query,
+)
+from subject_utils import (
+    SUBJECT_QUERY_PARAMS,
+    build_subject_index,
+    parse_subject_query,
+    query_subjects,
+)
+from sync_utils import (
+    FILE_LEVEL,
+    MEASURE_OVERVIEW,
+    SUBJECT_LEVEL,
+    file_path,
+    hashes_file,
+    record_key,
+)
 
 repo_path = Path(__file__).resolve().parent.parent
 
+data_path = repo_path / "data"
+snapshot_path = repo_path / Config.METADATA_SNAPSHOT_DIR
+
+# Metadata files published by the updater in each snapshot
+SNAPSHOT_FILES = {
+    'files': "guts-file-level-metadata.json",
+    'measures': "guts-measure-overview.json",
+    'subjects': "guts-subject-level-metadata.json",
+    'availability': "guts-subject-availability.npz",
+}
+# Files derived from the metadata files by the updater, published next to them
+DERIVED_FILES = {
+    'stats': "guts-subject-stats.npz",
+    'search_index': "guts-measure-search-index.json",
+}
+# Record types of the snapshot metadata files whose changes can be requested
+RECORD_TYPES = {
+    'files': FILE_LEVEL,
+    'measures': MEASURE_OVERVIEW,
+    'subjects': SUBJECT_LEVEL,
+}
+# Number of computed differences between snapshot versions kept per process
+CHANGES_CACHE_SIZE = 32
+# Metadata files maintained in the repository's data directory
+STATIC_FILES = {
+    'cohorts': "guts-cohorts.json",
+    'data_categories': "guts-data-categories.json",
+    'data_types': "guts-data-types.json",
+    'demographics': "guts-demographics.json",
+}
+
+
+def get_snapshot():
+    """Return the current metadata snapshot (or None if none was published yet).
+
+    Within a request the snapshot is resolved once, so that all metadata
+    served by that request comes from the same consistent version.
+    """
+    if not has_request_context():
+        return current_snapshot(snapshot_path)
+    if 'metadata_snapshot' not in g:
+        g.metadata_snapshot = current_snapshot(snapshot_path)
+    return g.metadata_snapshot
+
+
+def metadata_path(metadata_type):
+    """Path of a metadata file in the current snapshot, falling back to the data directory."""
+    if metadata_type in STATIC_FILES:
+        return data_path / STATIC_FILES[metadata_type]
+    name = SNAPSHOT_FILES[metadata_type]
+    snapshot = get_snapshot()
+    if snapshot is not None and name in snapshot.files:
+        return snapshot.path / name
+    return data_path / name
+
+
+def load_availability_entry(path, stat):
+    """Load the columnar availability matrix written by update_metadata.py."""
+    return CacheEntry(path, stat, AvailabilityMatrix.load(path))
+
+
+# Parsed metadata files, kept in memory per worker process
+metadata_cache = MetadataCache(metadata_path)
+availability_cache = MetadataCache(metadata_path, loader=load_availability_entry)
+
+
+def get_metadata_entry(metadata_type):
+    """Return the cache entry (parsed data and serialized JSON) of a metadata file."""
+    return metadata_cache.get(metadata_type)
+
+
 def load_metadata(metadata_type):
-    mpaths = {
-        'files': repo_path / "data" / "guts-file-level-metadata.json",
-        'measures': repo_path / "data" / "guts-measure-overview.json",
-        'subjects': repo_path / "data" / "guts-subject-level-metadata.json",
-        'cohorts': repo_path / "data" / "guts-cohorts.json",
-        'data_categories': repo_path / "data" / "guts-data-categories.json",
-        'data_types': repo_path / "data" / "guts-data-types.json",
-        'demographics': repo_path / "data" / "guts-demographics.json",
+    return get_metadata_entry(metadata_type).data
+
+
+def load_derived(entry, derived_type, loader):
+    """Load a file that the updater derived from a metadata file and published
+    next to it, or return None if there is none (e.g. outside of a snapshot)."""
+    try:
+        return loader(Path(entry.path).with_name(DERIVED_FILES[derived_type]))
+    except FileNotFoundError:
+        return None
+
+
+def load_json_file(path):
+    with open(path, 'rb') as f:
+        return json.loads(f.read())
+
+
+def make_cached_response(app, representation):
+    """Serve a pre-serialized representation, with content negotiation on
+    Accept-Encoding and conditional GET support (ETag / Last-Modified)."""
+    encoding = request.accept_encodings.best_match(representation.encodings(), default='identity')
+    if encoding not in representation.variants:
+        encoding = 'identity'
+    response = app.response_class(representation.variants[encoding], mimetype=representation.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(representation.etag(encoding))
+    response.last_modified = representation.last_modified
+    response.headers['Cache-Control'] = f"public, max-age={Config.METADATA_MAX_AGE}, must-revalidate"
+    # Turns the response into a 304 Not Modified if the client's validators match
+    return response.make_conditional(request)
+
+
+def make_metadata_response(app, metadata_type):
+    """Serve the full, pre-serialized content of a metadata file, as JSON or
+    (if the client prefers it in its Accept header) MessagePack or CBOR."""
+    entry = get_metadata_entry(metadata_type)
+    mimetype = request.accept_mimetypes.best_match(list(REPRESENTATIONS), default='application/json')
+    name, build = REPRESENTATIONS[mimetype]
+    response = make_cached_response(app, entry.derived(name, build))
+    response.vary.add('Accept')
+    return response
+
+
+def get_availability_entry():
+    """Return the cache entry holding the availability matrix of the subject-level metadata.
+
+    The matrix persisted by the updater is used when it was derived in the
+    same snapshot as the subject-level metadata file, or (outside of a
+    snapshot) is at least as recent as that file; otherwise it is built from
+    that file.
+    """
+    subjects = get_metadata_entry('subjects')
+    path = metadata_path('availability')
+    in_snapshot = path.parent != data_path and path.parent == Path(subjects.path).parent
+    try:
+        if in_snapshot or os.stat(path).st_mtime >= subjects.mtime:
+            return availability_cache.get('availability')
+    except FileNotFoundError:
+        pass
+    return subjects.derived(
+        'availability',
+        lambda e: CacheEntry(e.path, e.stat, AvailabilityMatrix.from_records(e.data)),
+    )
+
+
+def has_file_query(args):
+    return any(p in args for p in FILE_QUERY_PARAMS)
+
+
+def get_file_index():
+    return get_metadata_entry('files').derived('file_index', lambda e: FileIndex(e.data))
+
+
+def get_file_listing(args):
+    """Browse file-level metadata by directory, path prefix or glob."""
+    return browse_files(get_file_index(), args)
+
+
+def expand_file_selection(provider, file_paths, directories=(), prefixes=()):
+    """File paths of a data request: the explicitly selected files plus all
+    files of the provider under the selected directories and path prefixes,
+    without duplicates.
+
+    Expansion stops as soon as the selection exceeds the configured maximum
+    number of files, so oversized requests are rejected cheaply.
+    """
+    for name, paths in (("file_paths", file_paths), ("directories", directories), ("prefixes", prefixes)):
+        if not isinstance(paths, (list, tuple)) or not all(isinstance(p, str) for p in paths):
+            abort(400, description=f"Field '{name}' must be a list of strings.")
+    max_files = Config.DATA_REQUEST_MAX_FILES
+    selected = dict.fromkeys(file_paths)
+    if len(selected) > max_files:
+        abort(413, description=f"Data requests are limited to {max_files} files.")
+    if not directories and not prefixes:
+        return list(selected)
+    index = get_file_index()
+    selections = [normalize_dir(d) for d in directories] + [p.lstrip('/') for p in prefixes]
+    for selection in selections:
+        found = False
+        for record in index.iter_records(f"{provider}/{selection}"):
+            found = True
+            selected[file_path(record)] = None
+            if len(selected) > max_files:
+                abort(413, description=f"Data requests are limited to {max_files} files.")
+        if not found:
+            abort(400, description=f"No files of provider '{provider}' found under: {selection or '/'}")
+    return list(selected)
+
+
+def has_subject_query(args):
+    return any(p in args for p in SUBJECT_QUERY_PARAMS)
+
+
+def get_subject_index():
+    return get_metadata_entry('subjects').derived('index', build_subject_index)
+
+
+def search_subjects(args):
+    """Filter, project and paginate subject-level metadata."""
+    index = get_subject_index()
+    matrix = get_availability_entry().data
+    query = parse_subject_query(args, index['measures'], matrix)
+    return query_subjects(index, matrix, query)
+
+
+def _stats_for(entry):
+    """Load (or compute) the aggregate cube of an availability matrix, with a cache of query results."""
+    cube = load_derived(entry, 'stats', lambda path: StatsCube.load(path, entry.data))
+    if cube is None:
+        cube = StatsCube(entry.data)
+    return lru_cache(maxsize=STATS_CACHE_SIZE)(lambda query: compute_stats(entry.data, cube, query))
+
+
+def _cached_stats(entry):
+    return entry.derived('stats', _stats_for)
+
+
+def get_stats(args):
+    """Availability counts per measure, grouped and filtered as requested."""
+    entry = get_availability_entry()
+    query = parse_stats_query(args, entry.data)
+    return _cached_stats(entry)(query)
+
+
+def _get_measure_overview():
+    """Return the measures entry, the signature of the reference files and
+    the measure overview model resolved against them."""
+    measures = get_metadata_entry('measures')
+    references = [get_metadata_entry(t) for t in ('cohorts', 'data_types', 'data_categories')]
+    # The model also has to be rebuilt when one of the reference files changes
+    version = tuple((e.ino, e.mtime, e.size) for e in references)
+    overview = measures.derived_version(
+        'overview', version, lambda e: MeasureOverview(e.data, *(r.data for r in references)),
+    )
+    return measures, version, overview
+
+
+def get_measure_overview():
+    """Return the parsed measure overview model, with cohorts, data types and
+    data categories resolved against their metadata files."""
+    return _get_measure_overview()[2]
+
+
+def get_search_index():
+    measures, version, overview = _get_measure_overview()
+    return measures.derived_version(
+        'search_index', version,
+        lambda e: SearchIndex(overview, load_derived(e, 'search_index', load_json_file)),
+    )
+
+
+def get_search_results(args):
+    """Ranked full-text search over the measure overview."""
+    return search_measures(get_search_index(), args)
+
+
+def get_measure_facets():
+    """Number of measures per facet value, and values that could not be resolved."""
+    overview = get_measure_overview()
+    return {
+        'facets': overview.facet_counts(),
+        'unresolved': overview.unresolved,
+    }
+
+
+def get_measures_by_facets(args):
+    """Measures with the requested facet values."""
+    return lookup_measures(get_measure_overview(), args)
+
+
+@lru_cache(maxsize=CHANGES_CACHE_SIZE)
+def _diff_record_hashes(base_path, current_path):
+    """Keys of the records added, changed and removed between two versions of a
+    metadata file (snapshot files never change, so their paths identify them)."""
+    with open(base_path, 'r', encoding='utf-8') as f:
+        base = json.load(f)
+    with open(current_path, 'r', encoding='utf-8') as f:
+        current = json.load(f)
+    added = [k for k in current if k not in base]
+    changed = [k for k, h in current.items() if k in base and base[k] != h]
+    removed = [k for k in base if k not in current]
+    return added, changed, removed
+
+
+def get_metadata_changes(metadata_type, since):
+    """Records added, changed and removed since a previous snapshot version.
+
+    Records are identified by key: 'subject|session' for subjects,
+    'provider|path' for files and 'short_name|mapping' for measures. If the
+    previous version is no longer available, the response asks the client
+    to reload the whole metadata file instead.
+    """
+    meta_type = RECORD_TYPES[metadata_type]
+    name = hashes_file(SNAPSHOT_FILES[metadata_type])
+    snapshot = get_snapshot()
+    result = {
+        'version': snapshot.version if snapshot is not None else None,
+        'since': since,
+        'full_reload': False,
+    }
+    base = load_snapshot(snapshot_path, since) if since else None
+    if snapshot is None or base is None or name not in snapshot.files or name not in base.files:
+        return dict(result, full_reload=True)
+    if base.version == snapshot.version:
+        return dict(result, added=[], changed=[], removed=[])
+    # Diffs are cached by path: don't serve one against a version that was pruned since
+    if not base.path.is_dir():
+        return dict(result, full_reload=True)
+    try:
+        added, changed, removed = _diff_record_hashes(str(base.file_path(name)), str(snapshot.file_path(name)))
+    except FileNotFoundError:
+        # Pruned while the diff was being computed
+        return dict(result, full_reload=True)
+    entry = get_metadata_entry(metadata_type)
+    records = entry.derived('records_by_key', lambda e: {record_key(meta_type, r): r for r in e.data})
+    return dict(
+        result,
+        added=[{'key': k, 'record': records[k]} for k in added if k in records],
+        changed=[{'key': k, 'record': records[k]} for k in changed if k in records],
+        removed=removed,
+    )
+
+
+def warm_caches():
+    """Load all metadata files and build their representations, indexes and
+    aggregates ahead of requests, e.g. in the gunicorn master before it forks
+    its workers, so that the workers share them copy-on-write.
+
+    Metadata files that don't exist (yet) are skipped. Returns the version of
+    the snapshot that was loaded.
+    """
+    snapshot = get_snapshot()
+    builders = {name: build for name, build in REPRESENTATIONS.values()}
+    for metadata_type in list(RECORD_TYPES) + list(STATIC_FILES):
+        try:
+            entry = get_metadata_entry(metadata_type)
+        except HTTPException:
+            continue
+        for name, build in builders.items():
+            entry.derived(name, build)
+    for warm in (get_subject_index, get_file_index, get_search_index):
+        try:
+            warm()
+        except HTTPException:
+            pass
+    try:
+        _cached_stats(get_availability_entry())
+    except HTTPException:
+        pass
+    return snapshot.version if snapshot is not None else None
+
+
+def get_readiness():
+    """Whether this process can serve the metadata: all metadata files it
+    requires can be loaded. File-level metadata is optional, as it only
+    exists once providers shared it."""
+    snapshot = get_snapshot()
+    unavailable = []
+    for metadata_type in ['subjects', 'measures'] + list(STATIC_FILES):
+        try:
+            get_metadata_entry(metadata_type)
+        except HTTPException:
+            unavailable.append(metadata_type)
+    return {
+        'ready': not unavailable,
+        'version': snapshot.version if snapshot is not None else None,
+        'unavailable': unavailable,
     }
-    return load_json_from_file(mpaths[metadata_type])
-    
\ No newline at end of file
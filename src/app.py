@@ -7,12 +7,26 @@ if not (repo_path / ".env" ).exists():
 
 # Imports
 from api_utils import (
-    load_metadata,
+    expand_file_selection,
+    get_file_listing,
+    get_measure_facets,
+    get_measures_by_facets,
+    get_metadata_changes,
+    get_readiness,
+    get_search_results,
+    get_stats,
+    has_file_query,
+    has_subject_query,
+    make_metadata_response,
+    metadata_cache,
+    RECORD_TYPES,
+    search_subjects,
 )
 from config import Config
 from flask import (
     abort,
     Flask,
+    g,
     jsonify,
     redirect,
     render_template,
@@ -24,15 +38,29 @@ from flask_cors import CORS
 from oidc_utils import (
     get_oidc_token,
     get_user_info,
+    get_user_profile,
     revoke_oidc_token,
     get_auth_url,
+    store_user_profile,
 )
 
+from msgraph_utils import mail_service
 from neptune_utils import (
+    neptune_client,
     check_user,
+    check_users,
     delete_user,
     invite_user,
-    create_neptune_data_request,
+    user_cache,
+)
+from session_utils import (
+    ServerSession,
+    create_session_interface,
+)
+from submit_utils import (
+    job_queue,
+    job_workers,
+    submit_data_request,
 )
 
 # Setup flask app
@@ -47,11 +75,57 @@ if not app.config['FLASK_SECRET_KEY']:
 
 app.secret_key = app.config['FLASK_SECRET_KEY']
 
+# Keep session data server-side, with only the session id in the cookie
+session_interface = create_session_interface(app.config, repo_path)
+if session_interface is not None:
+    app.session_interface = session_interface
+
 # Add CORS to allow requests from frontend
-CORS(app, origins=[app.config['FRONTEND_URL']], supports_credentials=True)
+CORS(
+    app,
+    origins=[app.config['FRONTEND_URL']],
+    supports_credentials=True,
+    expose_headers=['X-Metadata-Version'],
+)
+
+
+def start_background_services():
+    """Start the background threads of this process: the job workers and the
+    mail service. Called by gunicorn in every worker after it was forked."""
+    job_workers.start()
+    mail_service.start()
+
+
+@app.before_request
+def start_job_workers():
+    """Start the background workers of this process, so that queued data
+    requests (also those left from before a restart) are processed."""
+    job_workers.start()
+
+
+@app.after_request
+def add_metadata_version(response):
+    """Report the metadata snapshot version that a request was served from."""
+    snapshot = g.get('metadata_snapshot')
+    if snapshot is not None:
+        response.headers['X-Metadata-Version'] = snapshot.version
+    return response
 
 
 # API
+@app.route('/api/health', methods=['GET'])
+def health():
+    """Liveness probe: this worker is up and handling requests."""
+    return jsonify({'status': 'ok'}), 200
+
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    """Readiness probe: the metadata can be served, and from which snapshot version."""
+    status = get_readiness()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
 @app.route('/api/user/<email>', methods=['GET', 'POST', 'DELETE'])
 def user(email):
     """"""
@@ -63,6 +137,21 @@ def user(email):
         return jsonify(delete_user(email))
 
 
+@app.route('/api/users/check', methods=['POST'])
+def check_user_list():
+    """Check many SRAM users at once: takes {"emails": [...]} and returns the
+    user (or an error) per email."""
+    if not session.get('is_authenticated'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    data = request.get_json(silent=True)
+    emails = data.get('emails') if isinstance(data, dict) else None
+    if not isinstance(emails, list) or not all(isinstance(e, str) for e in emails):
+        abort(400, description="Request body must be a JSON object with a list of 'emails'.")
+    if len(emails) > app.config['SRAM_CHECK_MAX_EMAILS']:
+        abort(400, description=f"At most {app.config['SRAM_CHECK_MAX_EMAILS']} emails can be checked at once.")
+    return jsonify(check_users(emails)), 200
+
+
 @app.route('/api/login')
 def login():
     """Initiate the OIDC login process by redirecting the user to the authorization URL."""
@@ -82,7 +171,9 @@ def oidc_callback():
     tokens = get_oidc_token(app.config, code)
 
     if 'access_token' in tokens:
-        # Store tokens securely in the session (server-side)
+        # Store tokens securely in the session (server-side), under a new session id
+        if isinstance(session, ServerSession):
+            session.regenerate()
         session['access_token'] = tokens['access_token']
         session['id_token'] = tokens['id_token']
         session['is_authenticated'] = True
@@ -90,7 +181,7 @@ def oidc_callback():
         # Fetch user profile info from the OIDC UserInfo endpoint
         user_info = get_user_info(app.config, tokens['access_token'])
         if user_info:
-            session['user_profile'] = user_info  # Store user profile in session
+            store_user_profile(app.config, user_info)  # Store user profile in session
             # Redirect back to the frontend, include the profile info
             return render_template('redirect_user_info.html', userinfo=user_info)
         else:
@@ -101,11 +192,11 @@ def oidc_callback():
 
 @app.route('/api/profile')
 def profile():
-    """Fetch and return the user's profile information using the OIDC access token."""
+    """Return the user's profile information: cached in the session while the
+    ID token validates locally, and otherwise fetched using the OIDC access token."""
     if not session.get('is_authenticated'):
         return jsonify({'error': 'Not authenticated'}), 401
-    access_token = session.get('access_token')
-    user_info = get_user_info(app.config, access_token)
+    user_info = get_user_profile(app.config)
     if user_info:
         return jsonify(user_info)
     return jsonify({'error': 'Failed to fetch user info'}), 400
@@ -123,23 +214,177 @@ def logout():
 
 @app.route('/api/submit', methods=['POST'])
 def create_data_request():
-    """Handle form submissions from the frontend and forward them securely to
-    to the external Neptune API."""
+    """Handle form submissions from the frontend and queue them for secure
+    submission to the external Neptune API, answering 202 with a job id.
+
+    Besides explicit file_paths, whole directories (directories=) and path
+    prefixes (prefixes=) of the provider can be selected; these are expanded
+    against the file-level metadata.
+    """
     print("\nReceived data request payload from frontend")
     if not session.get('is_authenticated'):
         print("!User is not authenticated!")
         return jsonify({'error': 'Not authenticated'}), 401
+    # Jobs are owned by the user's subject identifier, so only its owner can look one up
+    owner = session.get('user_profile', {}).get('sub')
+    if not owner:
+        print("!User has no subject identifier!")
+        return jsonify({'error': 'Not authenticated'}), 401
     print("User is authenticated; checking data:")
-    incoming_data = request.json  # Data coming in from the frontend POST
+    incoming_data = request.get_json(silent=True)  # Data coming in from the frontend POST
+    if not isinstance(incoming_data, dict):
+        abort(400, description="Request body must be a JSON object.")
+    missing = [k for k in ('provider_friendly', 'user_data', 'form_data') if k not in incoming_data]
+    if missing:
+        abort(400, description=f"Missing field(s): {', '.join(missing)}")
+    incoming_data["file_paths"] = expand_file_selection(
+        incoming_data["provider_friendly"],
+        incoming_data.get("file_paths", []),
+        directories=incoming_data.get("directories", []),
+        prefixes=incoming_data.get("prefixes", []),
+    )
+    if not incoming_data["file_paths"]:
+        abort(400, description="No files selected.")
     print(f'- provider_friendly: {incoming_data["provider_friendly"]}')
     print(f'- nr of file_paths: {len(incoming_data["file_paths"])}')
-    print(f'- user_data: {incoming_data["user_data"]}')
-    print(f'- form_data: {incoming_data["form_data"]}')
-    print("Making request to neptune...")
-    api_response = create_neptune_data_request(incoming_data)
-    if api_response.status_code == 200:
-        return jsonify(api_response.json()), 200
-    return jsonify({'error': 'Failed to submit form data'}), api_response.status_code
+    job_id = submit_data_request(incoming_data, owner)
+    print(f"Queued data request {job_id}")
+    response = jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('data_request_status', job_id=job_id),
+    })
+    response.headers['Location'] = url_for('data_request_status', job_id=job_id)
+    return response, 202
+
+
+@app.route('/api/submit/<job_id>', methods=['GET'])
+def data_request_status(job_id):
+    """Return the status of a submitted data request: queued, running,
+    succeeded (with the Neptune response) or failed (with the error)."""
+    if not session.get('is_authenticated'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    owner = session.get('user_profile', {}).get('sub')
+    if not owner:
+        return jsonify({'error': 'Not authenticated'}), 401
+    job = job_queue.get(job_id)
+    if job is None or job['owner'] != owner:
+        abort(404, description=f"No data request found with id: {job_id}")
+    job.pop('owner')
+    return jsonify(job), 200
+
+
+@app.errorhandler(413)
+def request_too_large(error):
+    """Report oversized data requests (body size or number of files) as JSON."""
+    return jsonify({'error': error.description}), 413
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Return hit/miss/reload counters of this worker's metadata cache."""
+    if not session.get('is_authenticated'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    return jsonify(metadata_cache.stats()), 200
+
+
+@app.route('/api/files', methods=['GET'])
+def get_files():
+    """
+    API endpoint that returns file-level metadata. Without query parameters
+    the full metadata file is returned; otherwise it can be browsed as a tree
+    of '<provider>/<path>': list a directory (path=) with per-directory file
+    counts and total sizes, or find files by prefix (prefix=) or glob (glob=),
+    paginated with limit and cursor.
+    """
+    if not has_file_query(request.args):
+        return make_metadata_response(app, 'files')
+    return jsonify(get_file_listing(request.args)), 200
+
+
+@app.route('/api/subjects', methods=['GET'])
+def get_subjects():
+    """
+    API endpoint that returns subject-level metadata. Without query parameters
+    the full metadata file is returned; otherwise the records are filtered
+    (cohort, session, sex, age_min, age_max, has_primary, has_derivative),
+    projected onto the requested measures (fields) and paginated (limit, cursor).
+    """
+    if not has_subject_query(request.args):
+        return make_metadata_response(app, 'subjects')
+    return jsonify(search_subjects(request.args)), 200
+
+
+@app.route('/api/stats', methods=['GET'])
+def get_subject_stats():
+    """
+    API endpoint that returns the number of subject-sessions with primary and
+    derivative data per measure, cross-tabulated over the group_by fields
+    (cohort, session, sex, age_bin). Accepts the same filters as /api/subjects,
+    plus measure= to restrict the measures and age_bin= to set the bin width.
+    """
+    return jsonify(get_stats(request.args)), 200
+
+
+@app.route('/api/measures/search', methods=['GET'])
+def search_measures():
+    """
+    API endpoint for full-text search over the measure overview. Returns
+    measures matching all terms of q= (words or word prefixes), ranked by
+    relevance and with highlighted snippets, optionally filtered on the
+    cohort, data_type and data_category facets.
+    """
+    return jsonify(get_search_results(request.args)), 200
+
+
+@app.route('/api/measures/facets', methods=['GET'])
+def measure_facets():
+    """
+    API endpoint that returns the number of measures per cohort, (cohort, session),
+    data type, data subtype, data category and state.
+    """
+    return jsonify(get_measure_facets()), 200
+
+
+@app.route('/api/measures/lookup', methods=['GET'])
+def lookup_measures():
+    """
+    API endpoint that returns the measures (with parsed cohorts, sessions, data
+    categories and states) matching facet values, e.g.
+    ?cohort=eur&session=eur:2&data_category=parenting
+    """
+    return jsonify(get_measures_by_facets(request.args)), 200
+
+
+@app.route('/api/neptune/metrics', methods=['GET'])
+def neptune_metrics():
+    """Return per-endpoint latency metrics of this worker's Neptune client,
+    and the counters of its SRAM user cache."""
+    if not session.get('is_authenticated'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    return jsonify(dict(neptune_client.metrics(), user_cache=user_cache.stats())), 200
+
+
+@app.route('/api/mail/metrics', methods=['GET'])
+def mail_metrics():
+    """Return sent/failed counts and per-message latency of this worker's mail service."""
+    if not session.get('is_authenticated'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    return jsonify(mail_service.metrics()), 200
+
+
+@app.route('/api/<metadata>/changes', methods=['GET'])
+def get_metadata_changes_since(metadata):
+    """
+    API endpoint that returns the file-level, measure-level or subject-level
+    records that were added, changed or removed since a previous metadata
+    version (since=, as reported in the X-Metadata-Version header). If that
+    version is no longer available, full_reload is true and the client should
+    fetch the whole metadata file.
+    """
+    if metadata not in RECORD_TYPES:
+        abort(404, description=f"No known endpoint: {metadata}/changes")
+    return jsonify(get_metadata_changes(metadata, request.args.get('since'))), 200
 
 
 @app.route('/api/<metadata>', methods=['GET'])
@@ -152,7 +397,7 @@ def get_metadata(metadata):
     if metadata not in ['files', 'measures', 'subjects', 'cohorts', 'data_types', 'data_categories', 'demographics']:
         abort(404, description=f"No known endpoint: {metadata}")
 
-    return jsonify(load_metadata(metadata)), 200
+    return make_metadata_response(app, metadata)
 
 
 if __name__ == '__main__':
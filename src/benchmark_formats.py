@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Compare the wire formats that metadata can be served in (JSON, MessagePack,
+# CBOR): payload size (plain and compressed) and encode/decode time.
+#
+# Usage: python src/benchmark_formats.py [metadata file] [repeats]
+import gzip
+import json
+import sys
+import time
+from pathlib import Path
+
+from flask import Flask, jsonify
+
+from cache_utils import (
+    BROTLI_QUALITY,
+    GZIP_LEVEL,
+    brotli,
+    cbor2,
+    msgpack,
+    serialize_json,
+)
+
+repo_path = Path(__file__).resolve().parent.parent
+default_path = repo_path / "data" / "guts-subject-level-metadata.json"
+
+
+def best_time(function, repeats):
+    """Fastest of several runs of a function, in milliseconds."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run(path, repeats):
+    with open(path, 'rb') as f:
+        data = json.loads(f.read())
+    app = Flask(__name__)
+
+    def jsonify_body():
+        with app.app_context():
+            return jsonify(data).get_data()
+
+    formats = {
+        'jsonify': (jsonify_body, json.loads),
+        'json (cached)': (lambda: serialize_json(data), json.loads),
+    }
+    if msgpack is not None:
+        formats['msgpack'] = (lambda: msgpack.packb(data, use_bin_type=True), msgpack.unpackb)
+    if cbor2 is not None:
+        formats['cbor'] = (lambda: cbor2.dumps(data), cbor2.loads)
+
+    print(f"{path.name}: {len(data)} records, best of {repeats} runs")
+    print(f"{'format':<14}{'bytes':>12}{'gzip':>10}{'br':>10}{'encode ms':>12}{'decode ms':>12}")
+    for name, (encode, decode) in formats.items():
+        body = encode()
+        gzip_size = len(gzip.compress(body, compresslevel=GZIP_LEVEL))
+        br_size = len(brotli.compress(body, quality=BROTLI_QUALITY)) if brotli is not None else 0
+        encode_ms = best_time(encode, repeats)
+        decode_ms = best_time(lambda: decode(body), repeats)
+        print(f"{name:<14}{len(body):>12}{gzip_size:>10}{br_size:>10}{encode_ms:>12.2f}{decode_ms:>12.2f}")
+
+
+if __name__ == '__main__':
+    path = Path(sys.argv[1]) if len(sys.argv) > 1 else default_path
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    run(path, repeats)
@@ -0,0 +1,374 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from flask import abort
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses fall back to gzip
+    brotli = None
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, clients fall back to JSON
+    msgpack = None
+try:
+    import cbor2
+except ImportError:  # cbor2 is optional, clients fall back to JSON
+    cbor2 = None
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+
+def serialize_json(data):
+    """Serialize data to compact UTF-8 encoded JSON bytes."""
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# File extension of a metadata file encoded per media type by the updater, and
+# of its compressed variants per content coding (published next to the file)
+ENCODED_EXTENSIONS = {'application/json': 'json'}
+if msgpack is not None:
+    ENCODED_EXTENSIONS['application/msgpack'] = 'msgpack'
+if cbor2 is not None:
+    ENCODED_EXTENSIONS['application/cbor'] = 'cbor'
+COMPRESSED_EXTENSIONS = {'br': 'br', 'gzip': 'gz'}
+
+
+def encode(data, mimetype):
+    """Encode data as one of the media types of ENCODED_EXTENSIONS."""
+    if mimetype == 'application/msgpack':
+        return msgpack.packb(data, use_bin_type=True)
+    if mimetype == 'application/cbor':
+        return cbor2.dumps(data)
+    return serialize_json(data)
+
+
+def compress_body(body, brotli_quality=BROTLI_QUALITY, skip=()):
+    """Compressed variants of a body per content coding."""
+    variants = {}
+    if brotli is not None and 'br' not in skip:
+        variants['br'] = brotli.compress(body, quality=brotli_quality)
+    if 'gzip' not in skip:
+        variants['gzip'] = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return variants
+
+
+def encoded_name(name, mimetype, encoding='identity'):
+    """Name of the file holding metadata file 'name' encoded as mimetype, and
+    compressed with the content coding, e.g. 'x.msgpack.br' for 'x.json'."""
+    name = f"{name.rsplit('.', 1)[0]}.{ENCODED_EXTENSIONS[mimetype]}"
+    if encoding != 'identity':
+        name = f"{name}.{COMPRESSED_EXTENSIONS[encoding]}"
+    return name
+
+
+def read_encoded(path, mimetype, encoding='identity'):
+    """Body of a metadata file as encoded by the updater, or None if it wasn't."""
+    path = Path(path)
+    try:
+        with open(path.with_name(encoded_name(path.name, mimetype, encoding)), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class Representation:
+    """A pre-serialized response body, stored once per content encoding.
+
+    Variants are keyed by content coding ('identity', 'gzip', 'br'), and each
+    variant has its own strong ETag derived from the identity body. Variants
+    that were precompressed (by the updater) are used as they are.
+    """
+    __slots__ = ('mimetype', 'variants', 'digest', 'last_modified')
+
+    def __init__(self, body, mimetype, last_modified, compress=True, precompressed=None):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.last_modified = last_modified
+        self.variants = {'identity': body}
+        self.variants.update(precompressed or {})
+        if compress:
+            self.variants.update(compress_body(body, skip=self.variants))
+
+    def etag(self, encoding):
+        if encoding == 'identity':
+            return self.digest
+        return f"{self.digest}-{encoding}"
+
+    def encodings(self):
+        """Available content codings, in order of server preference."""
+        return [e for e in ('br', 'gzip', 'identity') if e in self.variants]
+
+
+def encoded_representation(entry, mimetype):
+    """Build the representation of a cache entry as a media type, from the
+    files encoded and compressed by the updater where available."""
+    last_modified = datetime.fromtimestamp(int(entry.mtime), tz=timezone.utc)
+    if mimetype == 'application/json':
+        # The metadata file itself is indented; the compact body is kept on the entry
+        body = entry.body
+    else:
+        body = read_encoded(entry.path, mimetype)
+    precompressed = {}
+    if body is None:
+        body = encode(entry.data, mimetype)
+    else:
+        for encoding in COMPRESSED_EXTENSIONS:
+            variant = read_encoded(entry.path, mimetype, encoding)
+            if variant is not None:
+                precompressed[encoding] = variant
+    return Representation(body, mimetype, last_modified, precompressed=precompressed)
+
+
+def json_representation(entry):
+    """Build the JSON representation of a cache entry."""
+    return encoded_representation(entry, 'application/json')
+
+
+def msgpack_representation(entry):
+    """Build the MessagePack representation of a cache entry."""
+    return encoded_representation(entry, 'application/msgpack')
+
+
+def cbor_representation(entry):
+    """Build the CBOR representation of a cache entry."""
+    return encoded_representation(entry, 'application/cbor')
+
+
+# Representations of a metadata file per media type, in order of server preference
+REPRESENTATIONS = {'application/json': ('json', json_representation)}
+if msgpack is not None:
+    REPRESENTATIONS['application/msgpack'] = ('msgpack', msgpack_representation)
+    REPRESENTATIONS['application/x-msgpack'] = ('msgpack', msgpack_representation)
+if cbor2 is not None:
+    REPRESENTATIONS['application/cbor'] = ('cbor', cbor_representation)
+
+
+def load_json_entry(path, stat):
+    """Read and parse a JSON metadata file into a cache entry."""
+    try:
+        with open(path, 'rb') as file:
+            raw = file.read()
+        data = json.loads(raw)
+    except FileNotFoundError:
+        abort(404, description="Metadata file not found.")
+    except json.JSONDecodeError:
+        abort(500, description="Error decoding metadata file.")
+    return CacheEntry(path, stat, data, serialize_json(data))
+
+
+class CacheEntry:
+    """Parsed content of a single file, together with the file signature
+    (mtime and size) it was loaded from.
+
+    The parsed data is shared between requests and must be treated as read-only.
+    """
+    __slots__ = ('path', 'stat', 'ino', 'mtime', 'size', 'data', 'body', '_derived', '_lock')
+
+    def __init__(self, path, stat, data, body=None):
+        self.path = path
+        self.stat = stat
+        self.ino = stat.st_ino
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.data = data
+        self.body = body
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def matches(self, stat):
+        """Whether a stat() result refers to the same file content, e.g. the
+        same file hard-linked into a newer metadata snapshot."""
+        return (
+            self.ino == stat.st_ino
+            and self.mtime == stat.st_mtime
+            and self.size == stat.st_size
+        )
+
+    def derived(self, name, builder):
+        """Return a value derived from this entry's data, building it once.
+
+        Derived values (indexes, encodings, aggregates) live on the entry, so
+        they are dropped together with it when the underlying file changes.
+        """
+        try:
+            return self._derived[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = builder(self)
+            return self._derived[name]
+
+    def derived_version(self, name, version, builder):
+        """Like derived(), for a value that also depends on other inputs,
+        identified by 'version' (e.g. the signatures of other files). When the
+        version changes, the value is rebuilt and replaces the previous one.
+        """
+        cached = self._derived.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self._lock:
+            cached = self._derived.get(name)
+            if cached is None or cached[0] != version:
+                cached = (version, builder(self))
+                self._derived[name] = cached
+            return cached[1]
+
+
+class MetadataCache:
+    """Per-process cache of metadata files, invalidated on mtime/size change.
+
+    Every lookup resolves the key to a path and costs a single stat() call;
+    files are only re-read after they have been replaced, e.g. by the nightly
+    metadata update.
+    """
+
+    def __init__(self, resolve_path, loader=load_json_entry):
+        self._resolve_path = resolve_path
+        self._loader = loader
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def get(self, key):
+        """Return the (possibly cached) entry for a metadata key."""
+        path = self._resolve_path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._entries.pop(key, None)
+            abort(404, description="Metadata file not found.")
+        entry = self._entries.get(key)
+        if entry is not None and entry.matches(stat):
+            self.hits += 1
+            return entry
+        with self._lock:
+            # Another thread may have reloaded the file while we waited
+            entry = self._entries.get(key)
+            if entry is not None and entry.matches(stat):
+                self.hits += 1
+                return entry
+            if entry is None:
+                self.misses += 1
+            else:
+                self.reloads += 1
+            entry = self._loader(path, stat)
+            self._entries[key] = entry
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss/reload counters and the currently cached files."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'entries': {
+                key: {
+                    'path': str(entry.path),
+                    'mtime': entry.mtime,
+                    'size': entry.size,
+                }
+                for key, entry in self._entries.items()
+            },
+        }
+
+
+class _Flight:
+    """A computation in progress, awaited by all concurrent lookups of its key."""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TtlCache:
+    """Per-process cache of computed values (e.g. upstream API responses)
+    that expire 'ttl' seconds after they were computed.
+
+    Concurrent lookups of a key that isn't cached share a single computation
+    (single flight): one caller computes the value, the others wait for it.
+    Failed computations are not cached; their error is raised to all callers.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._flights = {}
+        # Keys invalidated while their value was being computed
+        self._invalidated = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, compute):
+        """Return the cached value of a key, or compute (and cache) it."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+                self._invalidated.discard(key)
+                leader = True
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None and key not in self._invalidated:
+                    self._entries[key] = (flight.value, time.monotonic() + self.ttl)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                self._invalidated.discard(key)
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, key):
+        """Drop the cached value of a key; a computation in progress for it
+        still answers its callers, but its result isn't cached."""
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._flights:
+                self._invalidated.add(key)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'entries': len(self._entries),
+        }
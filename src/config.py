@@ -17,17 +17,70 @@ class Config:
     OIDC_USERINFO_ENDPOINT = os.getenv('OIDC_USERINFO_ENDPOINT')
     OIDC_REVOKE_ENDPOINT = os.getenv('OIDC_REVOKE_ENDPOINT')
     OIDC_REDIRECT_URI = os.getenv('OIDC_REDIRECT_URI')
+    # Local validation of ID tokens: issuer (its JWKS endpoint is discovered
+    # unless set explicitly) and seconds to cache the signing keys. Without
+    # either, both are discovered at the origin of the authorization endpoint
+    OIDC_ISSUER = os.getenv('OIDC_ISSUER')
+    OIDC_JWKS_URI = os.getenv('OIDC_JWKS_URI')
+    OIDC_JWKS_TTL = int(os.getenv('OIDC_JWKS_TTL', '3600'))
+    # Seconds that profile claims are cached in the session before they are
+    # refreshed from the userinfo endpoint (at most until the ID token expires)
+    OIDC_PROFILE_TTL = int(os.getenv('OIDC_PROFILE_TTL', '900'))
     # SRAM collaboration user management
     SRAM_USER_ENDPOINT = os.getenv('SRAM_USER_ENDPOINT')
+    # Seconds to cache SRAM user lookups, and parallel lookups / maximum number
+    # of emails of a bulk check
+    SRAM_USER_CACHE_TTL = float(os.getenv('SRAM_USER_CACHE_TTL', '30'))
+    SRAM_CHECK_WORKERS = int(os.getenv('SRAM_CHECK_WORKERS', '8'))
+    SRAM_CHECK_MAX_EMAILS = int(os.getenv('SRAM_CHECK_MAX_EMAILS', '200'))
     # Neptune API interaction
     NEPTUNE_BASE_URL = os.getenv('NEPTUNE_BASE_URL')
     NEPTUNE_USERNAME = os.getenv('NEPTUNE_USERNAME')
     NEPTUNE_PASSWORD = os.getenv('NEPTUNE_PASSWORD')
     NEPTUNE_CERT_PATH = os.getenv('NEPTUNE_CERT_PATH')
+    NEPTUNE_POOL_SIZE = int(os.getenv('NEPTUNE_POOL_SIZE', '10'))
+    NEPTUNE_CONNECT_TIMEOUT = float(os.getenv('NEPTUNE_CONNECT_TIMEOUT', '5'))
+    NEPTUNE_READ_TIMEOUT = float(os.getenv('NEPTUNE_READ_TIMEOUT', '120'))
+    # Maximum number of concurrent Neptune requests made by the metadata updater
+    NEPTUNE_FETCH_WORKERS = int(os.getenv('NEPTUNE_FETCH_WORKERS', '4'))
+    # Seconds to wait for Neptune to respond to a data request submission
+    NEPTUNE_SUBMIT_TIMEOUT = float(os.getenv('NEPTUNE_SUBMIT_TIMEOUT', '300'))
+    # Data request submission limits: request body size (bytes, enforced by
+    # Flask with 413) and number of files after expanding directory selections
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', str(16 * 1024 * 1024)))
+    DATA_REQUEST_MAX_FILES = int(os.getenv('DATA_REQUEST_MAX_FILES', '100000'))
+    # Queue of submitted data requests (SQLite database, relative to the repository
+    # root), processed by background workers with retries and exponential backoff
+    JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'data/_jobs.sqlite3')
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '8'))
+    JOB_RETRY_BASE_DELAY = float(os.getenv('JOB_RETRY_BASE_DELAY', '10'))
+    JOB_RETRY_MAX_DELAY = float(os.getenv('JOB_RETRY_MAX_DELAY', '1800'))
+    # Seconds after which a job claimed by a worker that died is handed out again
+    JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '900'))
     # Flask session configuration
+    # Session data is kept server-side ('sqlite', shared by worker processes, or
+    # 'memory', for a single process) with only an opaque id in the cookie;
+    # 'cookie' keeps Flask's signed cookie sessions
+    SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+    SESSION_SQLITE_PATH = os.getenv('SESSION_SQLITE_PATH', 'data/_web_sessions.sqlite3')
+    SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+    # Seconds after which an unused session expires
+    SESSION_LIFETIME = int(os.getenv('SESSION_LIFETIME', str(8 * 3600)))
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     # SESSION_COOKIE_SECURE = os.getenv('SESSION_COOKIE_SECURE', 'True').lower() == 'true'  # True in production
+    # Published metadata snapshots (relative to the repository root) and how many to keep
+    METADATA_SNAPSHOT_DIR = os.getenv('METADATA_SNAPSHOT_DIR', 'data/snapshots')
+    METADATA_SNAPSHOT_RETENTION = int(os.getenv('METADATA_SNAPSHOT_RETENTION', '5'))
+    # Metadata responses: seconds a client may reuse a response before revalidating
+    METADATA_MAX_AGE = int(os.getenv('METADATA_MAX_AGE', '0'))
     MSGRAPH_TENANT_ID = os.getenv('MSGRAPH_TENANT_ID')
     MSGRAPH_CLIENT_ID = os.getenv('MSGRAPH_CLIENT_ID')
     MSGRAPH_CLIENT_SECRET = os.getenv('MSGRAPH_CLIENT_SECRET')
+    MSGRAPH_BASE_URL = os.getenv('MSGRAPH_BASE_URL', 'https://graph.microsoft.com/v1.0')
+    # Confirmation emails: concurrent Graph requests, messages per $batch request
+    # (at most 20), and seconds to wait for more messages before sending a batch
+    MAIL_CONCURRENCY = int(os.getenv('MAIL_CONCURRENCY', '4'))
+    MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', '20'))
+    MAIL_BATCH_WINDOW = float(os.getenv('MAIL_BATCH_WINDOW', '0.1'))
@@ -0,0 +1,208 @@
+import base64
+import re
+from bisect import (
+    bisect_left,
+    bisect_right,
+)
+from itertools import accumulate
+from flask import abort
+from subject_utils import get_number_arg
+from sync_utils import (
+    file_path,
+    file_size,
+)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Query parameters that select the browse mode of the files endpoint
+FILE_QUERY_PARAMS = ['path', 'prefix', 'glob', 'limit', 'cursor']
+# Top-level directory for records without a provider
+UNKNOWN_PROVIDER = "unknown"
+# Sorts after every character that can appear in a path
+_END = '\U0010ffff'
+
+
+def full_path(record):
+    """Path of a file-level metadata record in the browse tree: '<provider>/<path>'."""
+    provider = record.get('explorer_provider') or UNKNOWN_PROVIDER
+    return f"{provider}/{str(file_path(record) or '').strip('/')}"
+
+
+def normalize_dir(path):
+    """Normalize a directory path given in a query, e.g. '/eur/sub-01' -> 'eur/sub-01/'."""
+    path = (path or '').strip().strip('/')
+    return f"{path}/" if path else ''
+
+
+def glob_to_regex(pattern):
+    """Translate a path glob into a regex: '*' and '?' stay within a path
+    segment, '**' matches across segments."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile(''.join(parts) + r'\Z')
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except Exception:
+        abort(400, description="Invalid cursor.")
+
+
+class FileIndex:
+    """Sorted-prefix index over file-level metadata.
+
+    All files are kept sorted by their '<provider>/<path>', so the files under
+    any directory or prefix form one contiguous range that is found by
+    bisection; prefix sums of the file sizes give the size of any range in
+    constant time. Directories hold their sorted child names, so listing a
+    directory only touches its own entries.
+    """
+
+    def __init__(self, records):
+        items = sorted((full_path(r), i) for i, r in enumerate(records))
+        self.paths = [p for p, _ in items]
+        self.records = [records[i] for _, i in items]
+        self.sizes = [0] + list(accumulate(file_size(r) for r in self.records))
+        # Directory path ('' for the root, otherwise ending with '/') -> child
+        # directory names and child file positions
+        self.dirs = {'': (set(), [])}
+        for position, path in enumerate(self.paths):
+            parent = ''
+            *directories, _ = path.split('/')
+            for name in directories:
+                self.dirs[parent][0].add(name)
+                parent = f"{parent}{name}/"
+                self.dirs.setdefault(parent, (set(), []))
+            self.dirs[parent][1].append(position)
+        self.children = {
+            path: sorted(
+                [(name, 'directory', None) for name in subdirs]
+                + [(self.paths[p][len(path):], 'file', p) for p in files]
+            )
+            for path, (subdirs, files) in self.dirs.items()
+        }
+        del self.dirs
+
+    def range(self, prefix, after=None):
+        """Positions [start, end) of the files whose path starts with prefix."""
+        start = bisect_left(self.paths, prefix)
+        end = bisect_left(self.paths, prefix + _END, start)
+        if after is not None:
+            start = max(start, bisect_right(self.paths, after, start, end))
+        return start, end
+
+    def summary(self, prefix):
+        """Number and total size of the files under a prefix."""
+        start, end = self.range(prefix)
+        return end - start, self.sizes[end] - self.sizes[start]
+
+    def iter_records(self, prefix):
+        """Metadata records of the files whose path starts with prefix, in path order."""
+        start, end = self.range(prefix)
+        for position in range(start, end):
+            yield self.records[position]
+
+    def file_item(self, position):
+        return {
+            'path': self.paths[position],
+            'size': self.sizes[position + 1] - self.sizes[position],
+            'metadata': self.records[position],
+        }
+
+    def list_directory(self, path, limit, after=None):
+        """Entries of a directory: subdirectories with their file counts and
+        total sizes, and files with their metadata."""
+        entries = self.children.get(path)
+        if entries is None:
+            abort(404, description=f"No such directory: {path or '/'}")
+        start = bisect_right(entries, (after, _END)) if after is not None else 0
+        page = entries[start:start + limit]
+        items = []
+        for name, kind, position in page:
+            if kind == 'directory':
+                files, size = self.summary(f"{path}{name}/")
+                items.append({'name': name, 'type': kind, 'path': f"{path}{name}/", 'files': files, 'size': size})
+            else:
+                items.append(dict(self.file_item(position), name=name, type=kind))
+        files, size = self.summary(path)
+        return {
+            'path': path,
+            'files': files,
+            'size': size,
+            'total': len(entries),
+            'items': items,
+            'limit': limit,
+            'next_cursor': encode_cursor(page[-1][0]) if start + limit < len(entries) else None,
+        }
+
+    def list_prefix(self, prefix, limit, after=None):
+        """Files whose path starts with a prefix."""
+        files, size = self.summary(prefix)
+        start, end = self.range(prefix, after)
+        items = [self.file_item(p) for p in range(start, min(end, start + limit))]
+        return {
+            'prefix': prefix,
+            'files': files,
+            'size': size,
+            'total': files,
+            'items': items,
+            'limit': limit,
+            'next_cursor': encode_cursor(self.paths[start + limit - 1]) if start + limit < end else None,
+        }
+
+    def list_glob(self, pattern, limit, after=None):
+        """Files whose path matches a glob. Only the range of files under the
+        pattern's literal prefix (up to its first wildcard) is scanned."""
+        regex = glob_to_regex(pattern)
+        literal = re.split(r'[*?]', pattern, maxsplit=1)[0]
+        start, end = self.range(literal)
+        matches = [p for p in range(start, end) if regex.match(self.paths[p])]
+        size = sum(self.sizes[p + 1] - self.sizes[p] for p in matches)
+        offset = bisect_left(matches, bisect_right(self.paths, after)) if after is not None else 0
+        page = matches[offset:offset + limit]
+        return {
+            'glob': pattern,
+            'files': len(matches),
+            'size': size,
+            'total': len(matches),
+            'items': [self.file_item(p) for p in page],
+            'limit': limit,
+            'next_cursor': encode_cursor(self.paths[page[-1]]) if offset + limit < len(matches) else None,
+        }
+
+
+def browse_files(index, args):
+    """Directory listing (path=), prefix query (prefix=) or glob query (glob=)
+    over file-level metadata, paginated with limit and cursor."""
+    limit = get_number_arg(args, 'limit', int)
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    elif limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400, description=f"Query parameter 'limit' must be between 1 and {MAX_PAGE_SIZE}.")
+    after = decode_cursor(args['cursor']) if args.get('cursor') else None
+    modes = [m for m in ('path', 'prefix', 'glob') if m in args]
+    if len(modes) > 1:
+        abort(400, description="Only one of the query parameters 'path', 'prefix' and 'glob' can be given.")
+    if 'prefix' in args:
+        return index.list_prefix(args['prefix'].lstrip('/'), limit, after)
+    if 'glob' in args:
+        return index.list_glob(args['glob'].lstrip('/'), limit, after)
+    return index.list_directory(normalize_dir(args.get('path')), limit, after)
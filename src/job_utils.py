@@ -0,0 +1,281 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    progress TEXT NOT NULL DEFAULT '{}',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    lease_until REAL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_at);
+"""
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler for failures that retrying won't fix."""
+
+
+class Job:
+    """A claimed job. Handlers record the steps they completed with save(),
+    so that a retried job resumes after the last completed step."""
+
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.owner = row["owner"]
+        self.payload = json.loads(row["payload"])
+        self.progress = json.loads(row["progress"])
+        self.attempts = row["attempts"]
+        self.max_attempts = row["max_attempts"]
+
+    def save(self, step, result):
+        self.progress[step] = result
+        self.queue.save_progress(self.id, self.progress)
+
+
+class JobQueue:
+    """Durable job queue in a local SQLite database.
+
+    Jobs survive restarts of the application: a job that is claimed by a
+    worker holds a lease, and is handed out again once the lease expires
+    without the job being completed (e.g. because its process died).
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        """SQLite connection of the current thread (and process)."""
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def enqueue(self, kind, payload, owner=None, max_attempts=5):
+        """Add a job and return its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO jobs (id, kind, owner, status, payload, max_attempts, run_at, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, owner, QUEUED, json.dumps(payload), max_attempts, now, now, now),
+        )
+        return job_id
+
+    def claim(self, lease):
+        """Claim the next job that is due (or whose lease expired), or return None.
+
+        Jobs whose lease expired after their last attempt (e.g. because they
+        crash the process processing them) are failed instead.
+        """
+        db = self._connect()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "UPDATE jobs SET status = ?, error = 'Lease expired after ' || attempts || ' attempt(s)', "
+                "lease_until = NULL, updated = ? WHERE status = ? AND lease_until < ? AND attempts >= max_attempts",
+                (FAILED, now, RUNNING, now),
+            )
+            row = db.execute(
+                "SELECT * FROM jobs WHERE (status = ? AND run_at <= ?) OR (status = ? AND lease_until < ?) "
+                "ORDER BY run_at LIMIT 1",
+                (QUEUED, now, RUNNING, now),
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated = ? WHERE id = ?",
+                    (RUNNING, now + lease, now, row["id"]),
+                )
+                row = db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return Job(self, row) if row is not None else None
+
+    def next_run_at(self):
+        """Time at which the next queued job is due, or None if there is none."""
+        row = self._connect().execute("SELECT MIN(run_at) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()
+        return row[0]
+
+    def save_progress(self, job_id, progress):
+        self._connect().execute(
+            "UPDATE jobs SET progress = ?, updated = ? WHERE id = ?",
+            (json.dumps(progress), time.time(), job_id),
+        )
+
+    def complete(self, job_id):
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, error = NULL, lease_until = NULL, updated = ? WHERE id = ?",
+            (SUCCEEDED, time.time(), job_id),
+        )
+
+    def retry(self, job_id, error, delay):
+        """Put a job back in the queue, to run again after delay seconds."""
+        now = time.time()
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, error = ?, run_at = ?, lease_until = NULL, updated = ? WHERE id = ?",
+            (QUEUED, error, now + delay, now, job_id),
+        )
+
+    def fail(self, job_id, error):
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated = ? WHERE id = ?",
+            (FAILED, error, time.time(), job_id),
+        )
+
+    def get(self, job_id):
+        """Status of a job (without its payload), or None if it doesn't exist."""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "owner": row["owner"],
+            "status": row["status"],
+            "progress": json.loads(row["progress"]),
+            "error": row["error"],
+            "attempts": row["attempts"],
+            "max_attempts": row["max_attempts"],
+            "next_attempt": row["run_at"] if row["status"] == QUEUED else None,
+            "created": row["created"],
+            "updated": row["updated"],
+        }
+
+    def purge(self, older_than):
+        """Remove finished jobs last updated more than older_than seconds ago."""
+        self._connect().execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+            (SUCCEEDED, FAILED, time.time() - older_than),
+        )
+
+
+class JobWorkers:
+    """Background threads that process queued jobs.
+
+    Failed jobs are retried with exponential backoff (with jitter) until
+    they run out of attempts; handlers raise PermanentJobError to fail a job
+    immediately. Workers are started lazily, and again in every process that
+    calls start(), since threads don't survive a fork (e.g. gunicorn workers).
+    """
+
+    def __init__(self, queue, handlers, workers=2, lease=600, base_delay=5,
+                 max_delay=600, retention=30 * 24 * 3600, poll_interval=5):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.lease = lease
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._last_purge = 0.0
+
+    def start(self):
+        """Start the worker threads of this process, if not running yet."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._wake = threading.Event()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def notify(self):
+        """Wake up idle workers, e.g. after enqueueing a job."""
+        self._wake.set()
+
+    def backoff(self, attempts):
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _run(self):
+        while True:
+            try:
+                self._purge()
+                job = self.queue.claim(self.lease)
+                due = self.queue.next_run_at() if job is None else None
+            except sqlite3.Error as e:
+                print(f"Job queue unavailable: {e}")
+                time.sleep(self.poll_interval)
+                continue
+            if job is None:
+                # Sleep until the next retry is due, a job is enqueued, or
+                # the poll interval passed (jobs from other processes)
+                timeout = self.poll_interval if due is None else min(self.poll_interval, max(0.0, due - time.time()))
+                self._wake.wait(timeout)
+                self._wake.clear()
+                continue
+            self._process(job)
+
+    def _process(self, job):
+        handler = self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise PermanentJobError(f"No handler for jobs of kind '{job.kind}'")
+            handler(job)
+        except PermanentJobError as e:
+            print(f"Job {job.id} ({job.kind}) failed: {e}")
+            self._update(self.queue.fail, job.id, str(e))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts >= job.max_attempts:
+                print(f"Job {job.id} ({job.kind}) failed after {job.attempts} attempts: {error}")
+                traceback.print_exc()
+                self._update(self.queue.fail, job.id, error)
+            else:
+                delay = self.backoff(job.attempts)
+                print(f"Job {job.id} ({job.kind}) attempt {job.attempts} failed, retrying in {delay:.0f}s: {error}")
+                self._update(self.queue.retry, job.id, error, delay)
+        else:
+            self._update(self.queue.complete, job.id)
+
+    def _update(self, update, job_id, *args):
+        """Record the outcome of a job. If the queue is unavailable, the job is
+        handed out again once its lease expires (resuming after its saved steps)."""
+        try:
+            update(job_id, *args)
+        except sqlite3.Error as e:
+            print(f"Job queue unavailable, could not update job {job_id}: {e}")
+
+    def _purge(self):
+        if time.time() - self._last_purge < 3600:
+            return
+        self._last_purge = time.time()
+        self.queue.purge(self.retention)
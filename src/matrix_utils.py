@@ -0,0 +1,143 @@
+import os
+import numpy as np
+
+# Availability counts are stored as uint8; larger counts saturate
+MAX_COUNT = np.iinfo(np.uint8).max
+
+
+def normalize_session(session):
+    """Make session labels comparable, i.e. '02', '2' and 2 are the same session."""
+    session = str(session).strip()
+    if session.isdigit():
+        return session.lstrip('0') or '0'
+    return session
+
+
+def iter_measures(record):
+    """Yield (measure, availability dict) pairs of a subject-level record.
+
+    Measures nested in the 'demographics' block are named 'demographics.<key>'.
+    """
+    for key, value in record.items():
+        if not isinstance(value, dict):
+            continue
+        if key == 'demographics':
+            for k, v in value.items():
+                if isinstance(v, dict):
+                    yield f"demographics.{k}", v
+        else:
+            yield key, value
+
+
+def _to_age(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class AvailabilityMatrix:
+    """Columnar representation of subject-level metadata.
+
+    Rows are subject-sessions and columns are measures; the 'primary' and
+    'derivative' matrices hold the number of available files per cell.
+    """
+    __slots__ = (
+        'subjects', 'sessions', 'cohorts', 'sexes', 'ages', 'measures',
+        'primary', 'derivative', 'session_keys', 'measure_index', 'row_index',
+    )
+
+    def __init__(self, subjects, sessions, cohorts, sexes, ages, measures, primary, derivative):
+        self.subjects = subjects
+        self.sessions = sessions
+        self.cohorts = cohorts
+        self.sexes = sexes
+        self.ages = ages
+        self.measures = measures
+        self.primary = primary
+        self.derivative = derivative
+        self.session_keys = np.array([normalize_session(s) for s in sessions], dtype=str)
+        self.measure_index = {m: i for i, m in enumerate(measures.tolist())}
+        self.row_index = {
+            key: i for i, key in enumerate(zip(subjects.tolist(), sessions.tolist()))
+        }
+
+    def __len__(self):
+        return len(self.subjects)
+
+    @classmethod
+    def from_records(cls, records):
+        """Build the matrix from a list of subject-level metadata records."""
+        measure_index = {}
+        for record in records:
+            for measure, _ in iter_measures(record):
+                measure_index.setdefault(measure, len(measure_index))
+        primary = np.zeros((len(records), len(measure_index)), dtype=np.uint8)
+        derivative = np.zeros((len(records), len(measure_index)), dtype=np.uint8)
+        for i, record in enumerate(records):
+            for measure, counts in iter_measures(record):
+                j = measure_index[measure]
+                primary[i, j] = min(counts.get('primary') or 0, MAX_COUNT)
+                derivative[i, j] = min(counts.get('derivative') or 0, MAX_COUNT)
+        return cls(
+            subjects=np.array([str(r.get('subject', '')) for r in records], dtype=str),
+            sessions=np.array([str(r.get('session', '')) for r in records], dtype=str),
+            cohorts=np.array([str(r.get('cohort', '')) for r in records], dtype=str),
+            sexes=np.array([str(r.get('sex', '')).lower() for r in records], dtype=str),
+            ages=np.array([_to_age(r.get('age')) for r in records], dtype=np.float64),
+            measures=np.array(list(measure_index), dtype=str),
+            primary=primary,
+            derivative=derivative,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load a matrix that was saved with AvailabilityMatrix.save()."""
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(**{k: arrays[k] for k in (
+                'subjects', 'sessions', 'cohorts', 'sexes', 'ages',
+                'measures', 'primary', 'derivative',
+            )})
+
+    def save(self, path):
+        """Write the matrix to an (uncompressed) .npz file, replacing it atomically."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                subjects=self.subjects,
+                sessions=self.sessions,
+                cohorts=self.cohorts,
+                sexes=self.sexes,
+                ages=self.ages,
+                measures=self.measures,
+                primary=self.primary,
+                derivative=self.derivative,
+            )
+        os.replace(tmp_path, path)
+
+    def column(self, measure, kind='primary'):
+        """Counts of a single measure for all rows."""
+        return getattr(self, kind)[:, self.measure_index[measure]]
+
+    def mask(self, cohort=None, session=None, sex=None, age_min=None, age_max=None,
+             has_primary=(), has_derivative=()):
+        """Boolean row mask of subject-sessions matching all given filters."""
+        mask = np.ones(len(self), dtype=bool)
+        if cohort:
+            mask &= np.isin(self.cohorts, list(cohort))
+        if session:
+            mask &= np.isin(self.session_keys, [normalize_session(s) for s in session])
+        if sex:
+            mask &= np.isin(self.sexes, [s.lower() for s in sex])
+        if age_min is not None:
+            mask &= self.ages >= age_min
+        if age_max is not None:
+            mask &= self.ages <= age_max
+        if has_primary:
+            columns = [self.measure_index[m] for m in has_primary]
+            mask &= (self.primary[:, columns] > 0).all(axis=1)
+        if has_derivative:
+            columns = [self.measure_index[m] for m in has_derivative]
+            mask &= (self.derivative[:, columns] > 0).all(axis=1)
+        return mask
@@ -0,0 +1,144 @@
+from flask import abort
+from matrix_utils import normalize_session
+from search_utils import split_list
+
+# Facets of the measure overview with a reverse index (value -> measures)
+MEASURE_FACETS = ['cohort', 'session', 'data_type', 'data_type_sub', 'data_category', 'state']
+
+
+class Measure:
+    """A measure from the overview, with its packed string fields parsed and resolved.
+
+    - cohort 'A,B' -> cohorts ['eur', 'vu'] (resolved via guts-cohorts.json)
+    - session '1,2,3;1,2' -> sessions {'eur': ['1', '2', '3'], 'vu': ['1', '2']}
+    - data_category 'academics, parenting' -> data_categories ['academics', 'parenting']
+    - state 'raw, primary, derivatives' -> states ['raw', 'primary', 'derivatives']
+    """
+    __slots__ = (
+        'position', 'mapping', 'short_name', 'long_name', 'cohorts', 'sessions',
+        'data_type', 'data_type_sub', 'data_categories', 'states', 'record',
+    )
+
+    def __init__(self, position, record, cohort_codes):
+        self.position = position
+        self.record = record
+        self.mapping = record.get('mapping')
+        self.short_name = record.get('short_name')
+        self.long_name = record.get('long_name')
+        self.cohorts = [cohort_codes.get(c, c) for c in split_list(record.get('cohort'))]
+        # Sessions are listed per cohort, separated by ';', in the order of the
+        # cohorts; a single list applies to all cohorts
+        session_lists = [
+            [normalize_session(s) for s in split_list(group)]
+            for group in str(record.get('session') or '').strip().split(';')
+        ]
+        self.sessions = {
+            cohort: session_lists[i] if i < len(session_lists) else session_lists[-1]
+            for i, cohort in enumerate(self.cohorts)
+        } if session_lists else {}
+        self.data_type = (record.get('data_type') or '').strip() or None
+        self.data_type_sub = (record.get('data_type_sub') or '').strip() or None
+        self.data_categories = split_list(record.get('data_category'))
+        self.states = split_list(record.get('state'))
+
+    def facet_values(self, facet):
+        """Values of this measure for a facet, as used in the reverse indexes."""
+        if facet == 'cohort':
+            return self.cohorts
+        if facet == 'session':
+            return [(c, s) for c, sessions in self.sessions.items() for s in sessions]
+        if facet == 'data_type':
+            return [self.data_type] if self.data_type else []
+        if facet == 'data_type_sub':
+            return [self.data_type_sub] if self.data_type_sub else []
+        if facet == 'data_category':
+            return self.data_categories
+        if facet == 'state':
+            return self.states
+        return []
+
+    def to_dict(self):
+        """The original record, extended with the parsed fields."""
+        return dict(
+            self.record,
+            cohorts=self.cohorts,
+            sessions=self.sessions,
+            data_categories=self.data_categories,
+            states=self.states,
+        )
+
+
+class MeasureOverview:
+    """Typed model of the measure overview with precomputed reverse indexes,
+    so that facet lookups are dict hits instead of scans over split strings."""
+
+    def __init__(self, records, cohorts, data_types, data_categories):
+        self.cohort_codes = {c['code']: name for name, c in cohorts.items() if c.get('code')}
+        self.measures = [Measure(i, r, self.cohort_codes) for i, r in enumerate(records)]
+        self.by_short_name = {}
+        for m in self.measures:
+            self.by_short_name.setdefault(m.short_name, []).append(m)
+        self.index = {facet: {} for facet in MEASURE_FACETS}
+        for m in self.measures:
+            for facet in MEASURE_FACETS:
+                for value in m.facet_values(facet):
+                    self.index[facet].setdefault(value, []).append(m)
+        # Values that don't resolve against the reference metadata files
+        subtypes = {s['abbreviation'] for t in data_types.values() for s in t.get('subtypes', [])}
+        self.unresolved = {
+            'cohort': sorted(c for c in self.index['cohort'] if c not in cohorts),
+            'data_type': sorted(t for t in self.index['data_type'] if t not in data_types),
+            'data_type_sub': sorted(t for t in self.index['data_type_sub'] if t not in subtypes),
+            'data_category': sorted(c for c in self.index['data_category'] if c not in data_categories),
+        }
+
+    def resolve(self, facet, value):
+        """Normalize a facet value given in a query, e.g. cohort code 'A' -> 'eur'."""
+        if facet == 'cohort':
+            return self.cohort_codes.get(value, value)
+        return value
+
+    def lookup(self, facet, value):
+        """Measures with a given facet value; 'session' values are (cohort, session) pairs."""
+        return self.index[facet].get(value, [])
+
+    def facet_counts(self):
+        """Number of measures per facet value."""
+        counts = {}
+        for facet, values in self.index.items():
+            if facet == 'session':
+                counts[facet] = {f"{c}:{s}": len(m) for (c, s), m in values.items()}
+            else:
+                counts[facet] = {v: len(m) for v, m in values.items()}
+        return counts
+
+
+def parse_session_value(value):
+    """Parse a session facet value given as '<cohort>:<session>'."""
+    cohort, sep, session = value.partition(':')
+    if not sep:
+        abort(400, description="Session values must be given as '<cohort>:<session>', e.g. 'eur:2'.")
+    return cohort, normalize_session(session)
+
+
+def lookup_measures(overview, args):
+    """Measures matching all given facet values (any of the values within a facet)."""
+    selected = None
+    for facet in MEASURE_FACETS:
+        values = []
+        for arg in args.getlist(facet):
+            values += split_list(arg)
+        if not values:
+            continue
+        matching = {}
+        for value in values:
+            if facet == 'session':
+                cohort, session = parse_session_value(value)
+                key = (overview.resolve('cohort', cohort), session)
+            else:
+                key = overview.resolve(facet, value)
+            for m in overview.lookup(facet, key):
+                matching[m.position] = m
+        selected = matching if selected is None else {p: m for p, m in selected.items() if p in matching}
+    measures = overview.measures if selected is None else sorted(selected.values(), key=lambda m: m.position)
+    return [m.to_dict() for m in measures]
@@ -3,7 +3,11 @@ import asyncio
 from azure.identity.aio import ClientSecretCredential
 import base64
 from config import Config
+import httpx
 import json
+import os
+import threading
+import time
 from msgraph import GraphServiceClient
 from msgraph.generated.users.item.send_mail.send_mail_post_request_body import SendMailPostRequestBody
 from msgraph.generated.models.message import Message
@@ -17,6 +21,9 @@ from msgraph.generated.models.file_attachment import FileAttachment
 tenant_id = Config.MSGRAPH_TENANT_ID
 client_id = Config.MSGRAPH_CLIENT_ID
 client_secret = Config.MSGRAPH_CLIENT_SECRET
+graph_scope = 'https://graph.microsoft.com/.default'
+# Maximum number of requests in a single Graph JSON batch
+MAX_BATCH_SIZE = 20
 
 email_subject = 'TEST Data Request Submission Confirmation - GUTS Consortium'
 email_sender = 'gutsdata@eur.nl'
@@ -96,14 +103,244 @@ async def send_mail(graph_client, body, to_email, data = {'name': 'Jon Doe'}):
     await graph_client.users.by_user_id(email_sender).send_mail.post(request_body)
 
 
-async def test():
+def receipt_attachment(data):
+    """File attachment (Graph JSON) with the data request receipt."""
+    json_bytes = json.dumps(data, indent=4).encode('utf-8')
+    return {
+        "@odata.type": "#microsoft.graph.fileAttachment",
+        "name": "guts_data_request.json",
+        "contentType": "application/json",
+        "contentBytes": base64.b64encode(json_bytes).decode('ascii'),
+    }
+
+
+def build_message(body, to_email, attachments=()):
+    """Request body (Graph JSON) of a sendMail request for a confirmation email."""
+    return {
+        "message": {
+            "subject": email_subject,
+            "body": {"contentType": "Text", "content": body},
+            "toRecipients": [{"emailAddress": {"address": to_email}}],
+            "replyTo": [{"emailAddress": {"address": email_reply_to}}],
+            "attachments": list(attachments),
+        },
+        "saveToSentItems": True,
+    }
+
+
+class MailError(Exception):
+    """A message that Graph did not accept."""
+
+    def __init__(self, status_code, detail=None):
+        super().__init__(f"Sending mail failed: response code {status_code}" + (f" ({detail})" if detail else ""))
+        self.status_code = status_code
+
+
+class MailService:
+    """Long-lived sender of confirmation emails through Microsoft Graph.
+
+    The service runs its own event loop in a background thread, with a single
+    credential (whose access token is reused until it nearly expires) and a
+    single HTTP client. Messages sent around the same time are combined into
+    Graph JSON batches of up to 20 requests, and at most 'concurrency'
+    requests to Graph are in flight. Latency and failures are recorded per
+    message.
+    """
+
+    def __init__(self, tenant_id, client_id, client_secret, sender=email_sender,
+                 base_url='https://graph.microsoft.com/v1.0', concurrency=4,
+                 batch_size=MAX_BATCH_SIZE, batch_window=0.1, timeout=30):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.sender = sender
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.batch_window = batch_window
+        self.timeout = timeout
+        self._pid = None
+        self._loop = None
+        self._lock = threading.Lock()
+        self._metrics = {'sent': 0, 'failed': 0, 'requests': 0, 'batches': 0,
+                         'total_seconds': 0.0, 'max_seconds': 0.0, 'errors': {}}
+        self._metrics_lock = threading.Lock()
+
+    def start(self):
+        """Start the event loop thread of this process, if not running yet."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._loop = asyncio.new_event_loop()
+            started = threading.Event()
+            threading.Thread(target=self._run_loop, args=(started,), name="mail-service", daemon=True).start()
+            started.wait()
+            self._pid = os.getpid()
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._client = httpx.AsyncClient(timeout=self.timeout)
+        self._credential = None
+        self._token = None
+        self._tasks = set()
+        collector = self._loop.create_task(self._collect())
+        started.set()
+        self._loop.run_forever()
+        collector.cancel()
+        self._loop.run_until_complete(asyncio.gather(collector, return_exceptions=True))
+        self._loop.close()
+
+    def send(self, body, to_email, data=None):
+        """Queue a confirmation email (with the receipt 'data' attached, if given).
+
+        Returns a concurrent.futures.Future that resolves when Graph accepted
+        the message, or raises MailError (or a connection error).
+        """
+        attachments = [receipt_attachment(data)] if data is not None else []
+        message = build_message(body, to_email, attachments)
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self._submit(message), self._loop)
+
+    async def _submit(self, message):
+        future = self._loop.create_future()
+        await self._queue.put((message, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        """Take queued messages in batches: a batch is sent when it is full or
+        when batch_window seconds passed since its first message."""
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            task = self._loop.create_task(self._send_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _authorization(self):
+        """Authorization header, with the access token cached until shortly before it expires."""
+        if self._token is None or self._token.expires_on - 300 < time.time():
+            if self._credential is None:
+                self._credential = ClientSecretCredential(
+                    tenant_id=self.tenant_id,
+                    client_id=self.client_id,
+                    client_secret=self.client_secret)
+            self._token = await self._credential.get_token(graph_scope)
+        return {'Authorization': f"Bearer {self._token.token}"}
+
+    async def _send_batch(self, batch):
+        send_mail_url = f"/users/{self.sender}/sendMail"
+        async with self._semaphore:
+            try:
+                headers = await self._authorization()
+                if len(batch) == 1:
+                    r = await self._client.post(f"{self.base_url}{send_mail_url}", json=batch[0][0], headers=headers)
+                    results = [(r.status_code, None if r.status_code < 300 else r.text)]
+                else:
+                    requests = [
+                        {
+                            "id": str(i),
+                            "method": "POST",
+                            "url": send_mail_url,
+                            "headers": {"Content-Type": "application/json"},
+                            "body": message,
+                        }
+                        for i, (message, _, _) in enumerate(batch)
+                    ]
+                    r = await self._client.post(f"{self.base_url}/$batch", json={"requests": requests}, headers=headers)
+                    if r.status_code != 200:
+                        results = [(r.status_code, r.text)] * len(batch)
+                    else:
+                        responses = {item["id"]: item for item in r.json().get("responses", [])}
+                        results = [
+                            (responses.get(str(i), {}).get("status", 500),
+                             responses.get(str(i), {}).get("body"))
+                            for i in range(len(batch))
+                        ]
+            except Exception as e:
+                results = [e] * len(batch)
+        self._record(batch, results)
+
+    def _record(self, batch, results):
+        now = time.perf_counter()
+        with self._metrics_lock:
+            m = self._metrics
+            m['requests'] += 1
+            m['batches'] += int(len(batch) > 1)
+            for (_, future, queued), result in zip(batch, results):
+                seconds = now - queued
+                m['total_seconds'] += seconds
+                m['max_seconds'] = max(m['max_seconds'], seconds)
+                if isinstance(result, Exception):
+                    error, key = result, type(result).__name__
+                elif result[0] >= 300:
+                    error, key = MailError(*result), str(result[0])
+                else:
+                    error = None
+                if error is None:
+                    m['sent'] += 1
+                else:
+                    m['failed'] += 1
+                    m['errors'][key] = m['errors'].get(key, 0) + 1
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(seconds)
+                else:
+                    future.set_exception(error)
+
+    def metrics(self):
+        """Return the number of sent and failed messages, Graph requests and
+        batches, and the per-message latency (from queueing to Graph's answer)."""
+        with self._metrics_lock:
+            m = dict(self._metrics, errors=dict(self._metrics['errors']))
+        count = m['sent'] + m['failed']
+        m['mean_seconds'] = m['total_seconds'] / count if count else 0.0
+        return m
+
+    def close(self):
+        """Stop the event loop thread, closing the HTTP client and credential."""
+        if self._pid != os.getpid():
+            return
+        async def shutdown():
+            await self._client.aclose()
+            if self._credential is not None:
+                await self._credential.close()
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._pid = None
+
+
+mail_service = MailService(
+    tenant_id,
+    client_id,
+    client_secret,
+    base_url=Config.MSGRAPH_BASE_URL,
+    concurrency=Config.MAIL_CONCURRENCY,
+    batch_size=Config.MAIL_BATCH_SIZE,
+    batch_window=Config.MAIL_BATCH_WINDOW,
+)
+
+
+def test():
     """
     """
-    graph_client, credential = create_graph_client()
-    response = await send_mail(graph_client, email_body.format(name='Jon Doe'), "heunis@essb.eur.nl")
-    print(response)
-    await credential.close()
+    future = mail_service.send(email_body.format(name='Jon Doe'), "heunis@essb.eur.nl", {'name': 'Jon Doe'})
+    print(future.result())
+    print(mail_service.metrics())
+    mail_service.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(test())
\ No newline at end of file
+    test()
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 from pathlib import Path
+import codecs
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import threading
+import time
 from urllib.error import HTTPError
 import urllib.parse
 
 from utils import (
+    iter_json_array,
+    iter_json_object,
     write_json_to_file,
     load_json_from_file,
 )
 
+from cache_utils import TtlCache
 from config import Config
+from reference_utils import ReferenceRegistry
+from snapshot_utils import current_snapshot
 
 provider_friendly_names = ["eur", "lei", "vu", "aumc"]
 temp_provider_mapping = {
@@ -36,31 +46,113 @@ CERT_PATH = repo_path / Config.NEPTUNE_CERT_PATH
 USERNAME = Config.NEPTUNE_USERNAME
 PASSWORD = Config.NEPTUNE_PASSWORD
 SRAM_USER_ENDPOINT = Config.SRAM_USER_ENDPOINT
+SNAPSHOT_PATH = repo_path / Config.METADATA_SNAPSHOT_DIR
+
+class NeptuneRequestError(ValueError):
+    """A Neptune request that was answered with an error status."""
+
+    def __init__(self, status_code):
+        super().__init__(f"Unsuccessful request: response code {status_code}")
+        self.status_code = status_code
+
+
+class NeptuneClient:
+    """Thread-safe client for the Neptune API.
+
+    A single requests.Session owns a pool of keep-alive HTTPS connections,
+    so calls don't pay a new TCP connect, TLS handshake and CA bundle load
+    each time. Latency is recorded per endpoint.
+    """
+
+    def __init__(self, base_url, username, password, cert_path,
+                 pool_size=10, timeout=(5, 120)):
+        self.base_url = base_url
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._session.auth = (username, password)
+        self._session.verify = str(cert_path)
+        self._session.headers.update({'accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, endpoint, metric=None, **kwargs):
+        """Make a request to a Neptune endpoint, recording its latency under 'metric'."""
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        failed = True
+        try:
+            r = self._session.request(method, f"{self.base_url}/{endpoint}", **kwargs)
+            failed = r.status_code != 200
+            return r
+        finally:
+            self._record(f"{method} {metric or endpoint}", time.perf_counter() - start, failed)
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request('POST', endpoint, **kwargs)
+
+    def delete(self, endpoint, **kwargs):
+        return self.request('DELETE', endpoint, **kwargs)
+
+    def _record(self, name, seconds, failed):
+        with self._lock:
+            m = self._metrics.setdefault(name, {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            m['count'] += 1
+            m['errors'] += int(failed)
+            m['total_seconds'] += seconds
+            m['max_seconds'] = max(m['max_seconds'], seconds)
+
+    def metrics(self):
+        """Return request count, error count and latency per endpoint."""
+        with self._lock:
+            return {
+                name: dict(m, mean_seconds=m['total_seconds'] / m['count'])
+                for name, m in self._metrics.items()
+            }
+
+    def close(self):
+        self._session.close()
+
+
+neptune_client = NeptuneClient(
+    BASE_URL,
+    USERNAME,
+    PASSWORD,
+    CERT_PATH,
+    pool_size=Config.NEPTUNE_POOL_SIZE,
+    timeout=(Config.NEPTUNE_CONNECT_TIMEOUT, Config.NEPTUNE_READ_TIMEOUT),
+)
+
+# SRAM user lookups: cached per email, and bulk lookups run in a bounded pool
+user_cache = TtlCache(Config.SRAM_USER_CACHE_TTL)
+user_check_executor = ThreadPoolExecutor(max_workers=Config.SRAM_CHECK_WORKERS, thread_name_prefix="sram-check")
+
 
 def check_env():
     if not USERNAME or not PASSWORD:
         raise ValueError(f"Neptune authorization credentials not set. Please set 'EXPLORER_USER' and 'EXPLORER_PASSWD' before making a request to a Neptune endpoint")
 
 
-def get_metadata(endpoint, params = {}):
+def get_metadata(endpoint, params = None):
     if endpoint not in KNOWN_ENDPOINTS:
         raise ValueError(f"Argument '{endpoint}' is not one of the allowed endpoint options")
     
     check_env()
 
-    if endpoint == "data_users":
+    params = dict(params or {})
+    # data users are listed per provider; callers that already fetched "users/me"
+    # can pass the provider id to avoid fetching it again
+    if endpoint == "data_users" and "provider_id" not in params:
         my_user = get_metadata("users/me")
         params["provider_id"] = my_user["provider_id"]
 
     # Get the desired metadata
-    r = requests.get(
-        f"{BASE_URL}/{endpoint}/",
-        auth=(USERNAME, PASSWORD),
-        headers={'accept': 'application/json'},
-        params=params,
-        # verify=False,
-        verify=str(CERT_PATH),
-    )
+    r = neptune_client.get(f"{endpoint}/", params=params, metric=endpoint)
     # Break if request failed
     if r.status_code != 200:
         raise ValueError(f"Unsuccessful request: response code {r.status_code}")
@@ -68,32 +160,63 @@ def get_metadata(endpoint, params = {}):
     return r.json()
 
 
-def check_user(email):
-    user_endpoint = f"{BASE_URL}/{SRAM_USER_ENDPOINT}/{urllib.parse.quote_plus(email)}"
+def stream_metadata(endpoint, params = None, chunk_size=64 * 1024):
+    """Like get_metadata, for endpoints returning a JSON array, but yield the
+    array's items one by one while the response is being downloaded."""
+    if endpoint not in KNOWN_ENDPOINTS:
+        raise ValueError(f"Argument '{endpoint}' is not one of the allowed endpoint options")
+
+    check_env()
+
+    r = neptune_client.get(f"{endpoint}/", params=params, metric=endpoint, stream=True)
+    with r:
+        # Break if request failed
+        if r.status_code != 200:
+            raise ValueError(f"Unsuccessful request: response code {r.status_code}")
+        decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')()
+        chunks = (decoder.decode(c) for c in r.iter_content(chunk_size=chunk_size))
+        yield from iter_json_array(chunks)
+
+
+def user_endpoint(email):
+    return f"{SRAM_USER_ENDPOINT}/{urllib.parse.quote_plus(email)}"
+
+
+def user_cache_key(email):
+    return email.strip().lower()
+
+
+def fetch_user(email):
     # Get the desired metadata
-    r = requests.get(
-        user_endpoint,
-        auth=(USERNAME, PASSWORD),
-        headers={'accept': 'application/json'},
-        params={},
-        verify=str(CERT_PATH),
-    )
+    r = neptune_client.get(user_endpoint(email), metric=SRAM_USER_ENDPOINT)
     # Break if request failed
     if r.status_code != 200:
         raise ValueError(f"Unsuccessful request: response code {r.status_code}")
     return r.json()
 
 
+def check_user(email):
+    """Look up an SRAM user; responses are cached for a short while, and
+    concurrent lookups of the same email share a single upstream request."""
+    return user_cache.get(user_cache_key(email), lambda: fetch_user(email))
+
+
+def check_users(emails):
+    """Look up many SRAM users, with at most SRAM_CHECK_WORKERS upstream
+    requests in parallel. Returns the user (or an error) per email."""
+    def check(email):
+        try:
+            return email, check_user(email)
+        except (ValueError, requests.RequestException) as e:
+            return email, {"error": str(e)}
+    return dict(user_check_executor.map(check, list(dict.fromkeys(emails))))
+
+
 def invite_user(email):
-    user_endpoint = f"{BASE_URL}/{SRAM_USER_ENDPOINT}/{urllib.parse.quote_plus(email)}"
-    # Get the desired metadata
-    r = requests.post(
-        user_endpoint,
-        auth=(USERNAME, PASSWORD),
-        headers={'accept': 'application/json'},
-        params={},
-        verify=str(CERT_PATH),
-    )
+    try:
+        r = neptune_client.post(user_endpoint(email), metric=SRAM_USER_ENDPOINT)
+    finally:
+        user_cache.invalidate(user_cache_key(email))
     # Break if request failed
     if r.status_code != 200:
         raise ValueError(f"Unsuccessful request: response code {r.status_code}")
@@ -101,19 +224,63 @@ def invite_user(email):
 
 
 def delete_user(email):
-    user_endpoint = f"{BASE_URL}/{SRAM_USER_ENDPOINT}/{urllib.parse.quote_plus(email)}"
-    r = requests.delete(
-        user_endpoint,
-        auth=(USERNAME, PASSWORD),
-        headers={'accept': 'application/json'},
-        params={},
-        verify=str(CERT_PATH),
-    )
+    try:
+        r = neptune_client.delete(user_endpoint(email), metric=SRAM_USER_ENDPOINT)
+    finally:
+        user_cache.invalidate(user_cache_key(email))
     # Break if request failed
     if r.status_code != 200:
         raise ValueError(f"Unsuccessful request: response code {r.status_code}")
     return r.json()
 
+def reference_path(name):
+    """Path of a reference data file written by the updater, in the current
+    metadata snapshot or (before the first snapshot) in the data directory."""
+    snapshot = current_snapshot(SNAPSHOT_PATH)
+    if snapshot is not None and name in snapshot.files:
+        return snapshot.path / name
+    return repo_path / "data" / name
+
+
+REFERENCE_FILES = ["_providers.json", "_data_users.json", "_projects.json"]
+_reference_registry = (None, None)
+_reference_lock = threading.Lock()
+
+
+def _reference_version(paths):
+    """Identify the content of the reference files: files in a snapshot never
+    change, so their paths suffice; files in the data directory are identified
+    by their mtime and size."""
+    version = []
+    for path in paths:
+        if path.parent == repo_path / "data":
+            stat = os.stat(path)
+            version.append((str(path), stat.st_mtime_ns, stat.st_size))
+        else:
+            version.append(str(path))
+    return tuple(version)
+
+
+def get_reference_registry():
+    """Return the indexed reference data of the current metadata snapshot,
+    loading it only when a new snapshot was published."""
+    global _reference_registry
+    paths = [reference_path(name) for name in REFERENCE_FILES]
+    try:
+        version = _reference_version(paths)
+    except FileNotFoundError:
+        version = None
+    key, registry = _reference_registry
+    if registry is not None and key == version:
+        return registry
+    with _reference_lock:
+        key, registry = _reference_registry
+        if registry is None or key != version:
+            registry = ReferenceRegistry(*(load_json_from_file(p) for p in paths))
+            _reference_registry = (version, registry)
+        return registry
+
+
 def create_new_session(incoming_data):
     """"""
     # Inputs from frontend
@@ -126,19 +293,15 @@ def create_new_session(incoming_data):
     user_data = incoming_data["user_data"]
     form_data = incoming_data["form_data"]
 
-    # First get providers, data-users, and projects:
-    providers = load_json_from_file(repo_path / "data" / "_providers.json")
-    data_users = load_json_from_file(repo_path / "data" / "_data_users.json")
-    projects = load_json_from_file(repo_path / "data" / "_projects.json")
+    # First get the indexed providers, data-users, and projects:
+    registry = get_reference_registry()
     # Isolate GUTS-Metadata project
-    found_project = next((p for p in projects if p["name"] == "GUTS-Metadata"), None)
-    if not found_project:
+    if not registry.project:
         raise ValueError("GUTS-Metadata project not found among projects")
     # Isolate SRAM provider
-    sram_provider = next((p for p in providers if p["friendly_name"] == "sram"), None)
-    if not sram_provider:
+    if not registry.provider("sram"):
         raise ValueError(f"SRAM provider not found in list of providers")
-    sram_endpoint = next((e for e in sram_provider["endpoints"]), None)
+    sram_endpoint = registry.endpoint("sram")
     if not sram_endpoint:
         raise ValueError(f"SRAM provider does not have any endpoints specified")
 
@@ -149,25 +312,15 @@ def create_new_session(incoming_data):
     # 1: Data provider service account ID
     #    - friendly name -> provider id -> project["service_accounts"] (swap key/value)
     inverse_mapping_friendly = {v: k for k, v in temp_provider_mapping.items()}
-    data_provider = next((p for p in providers if p["friendly_name"] == inverse_mapping_friendly[provider_friendly]), None)
+    data_provider = registry.provider(inverse_mapping_friendly.get(provider_friendly))
     if not data_provider:
         raise ValueError(f"No provider found with friendly name: {provider_friendly}")
-    data_endpoint = next((e for e in data_provider["endpoints"]), None)
+    data_endpoint = registry.endpoint(data_provider["friendly_name"])
     if not data_endpoint:
         raise ValueError(f"Data provider does not have any endpoints specified")
-    inverse_service_accounts = {v: k for k, v in found_project["service_accounts"].items()}
-    service_account_id = inverse_service_accounts[data_provider["_id"]]
-    participants.append(service_account_id)
-    # 2: Reviewer ID
-    #   - for each member in project["members"],
-    #     include if user["_id"] (in data_users) is member["_id"],
-    #     and user["role"] is "reviewer"
-    for member in found_project["members"]:
-        found_reviewers = [user for user in data_users
-                           if user["_id"] == member
-                           and user["role"] == "reviewer"]
-        for r in found_reviewers:
-            participants.append(r["_id"])
+    participants.append(registry.service_account(data_provider["_id"]))
+    # 2: Reviewer IDs: members of the project whose data user role is "reviewer"
+    participants += registry.reviewers
     # Now determine profiles and profile tags:
     # - profile of SRAM user
     # - profile of data provider
@@ -202,38 +355,41 @@ def create_new_session(incoming_data):
         user=sram_tag,
     ) 
 
-    # To create a data request, we have to create a session, with an event per file path
+    # To create a data request, we have to create a session, with an event per file path.
+    # The events are generated lazily while the request body is being sent.
     new_session = dict(
         access="shared",
-        events=[],
         lifetime=604800, # in seconds, current default = 1 week
         participants=participants,
         profiles=profiles,
         provenance=[],
     )
-
-    for f in file_paths:
-        new_event = dict(
+    events = (
+        dict(
             metadata=[],
             operation="request",
             path=f,
             profile_tags=profile_tags,
         )
-        new_session["events"].append(new_event)
+        for f in file_paths
+    )
 
-    return new_session
+    return new_session, events
 
 def create_neptune_data_request(incoming_data):
-    """Forward incoming data to the neptune API, session endpoint"""
-    new_session_dict = create_new_session(incoming_data)
-    r = requests.post(
-        f"{BASE_URL}/session",
-        auth=(USERNAME, PASSWORD),
-        headers={'Content-Type': 'application/json'},
-        verify=str(CERT_PATH),
-        json=new_session_dict,
+    """Forward incoming data to the neptune API, session endpoint.
+
+    The session is streamed as a chunked request body, so the size of the
+    file selection doesn't determine the memory used to send it.
+    """
+    new_session, events = create_new_session(incoming_data)
+    r = neptune_client.post(
+        "session",
+        data=iter_json_object(new_session, "events", events),
+        headers={"Content-Type": "application/json"},
+        timeout=(Config.NEPTUNE_CONNECT_TIMEOUT, Config.NEPTUNE_SUBMIT_TIMEOUT),
     )
     # Break if request failed
     if r.status_code != 200:
-        raise ValueError(f"Unsuccessful request: response code {r.status_code}")
-    return r
\ No newline at end of file
+        raise NeptuneRequestError(r.status_code)
+    return r
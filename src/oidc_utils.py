@@ -2,9 +2,22 @@ import requests
 import secrets
 import hashlib
 import base64
-from urllib.parse import urlencode
+import jwt
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode, urlsplit
 from flask import session
 
+# Seconds to wait for the OIDC provider's discovery and JWKS endpoints
+JWKS_TIMEOUT = 10
+# Seconds between attempts to discover the OIDC provider's configuration
+DISCOVERY_RETRY_INTERVAL = 300
+# Clock skew tolerated when checking the expiry of ID tokens
+ID_TOKEN_LEEWAY = 60
+# Number of validated ID tokens remembered per process
+VALIDATED_TOKENS_SIZE = 1024
+
 
 def generate_code_verifier():
     """Generates a code verifier string of between 43-128 characters."""
@@ -82,3 +95,195 @@ def revoke_oidc_token(config, access_token):
         headers={'Content-Type': 'application/x-www-form-urlencoded'}
     )
     return response.status_code == 200
+
+
+class JwksCache:
+    """Signing keys of the OIDC provider, fetched from its JWKS endpoint.
+
+    Keys are cached for 'ttl' seconds. A token signed with an unknown key id
+    triggers a refresh (at most once per min_refresh_interval seconds), so
+    key rotation is picked up without refetching the keys for every token.
+    """
+
+    def __init__(self, jwks_uri=None, issuer=None, ttl=3600, min_refresh_interval=60):
+        self.jwks_uri = jwks_uri
+        self.issuer = issuer
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._fetched = 0.0
+        self._attempted = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def configured(self):
+        return bool(self.jwks_uri or self.issuer)
+
+    def _refresh(self):
+        if not self.jwks_uri:
+            # Discover the JWKS endpoint from the issuer's OpenID configuration
+            r = requests.get(f"{self.issuer.rstrip('/')}/.well-known/openid-configuration", timeout=JWKS_TIMEOUT)
+            r.raise_for_status()
+            self.jwks_uri = r.json()['jwks_uri']
+        r = requests.get(self.jwks_uri, timeout=JWKS_TIMEOUT)
+        r.raise_for_status()
+        keys = {}
+        for key in r.json().get('keys', []):
+            if key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[key.get('kid')] = jwt.PyJWK(key)
+            except jwt.PyJWTError:
+                continue
+        self._keys = keys
+        self._fetched = time.time()
+
+    def get_key(self, kid):
+        """Return the signing key with a key id, or None if the provider doesn't have it."""
+        key = self._keys.get(kid)
+        if key is not None and time.time() - self._fetched < self.ttl:
+            return key
+        with self._lock:
+            now = time.time()
+            key = self._keys.get(kid)
+            stale = now - self._fetched >= self.ttl
+            if (key is None or stale) and now - self._attempted >= self.min_refresh_interval:
+                self._attempted = now
+                try:
+                    self._refresh()
+                except (requests.RequestException, KeyError, ValueError) as e:
+                    # Keep using the keys we have until the provider is reachable again
+                    print(f"Failed to fetch OIDC signing keys: {e}")
+            return self._keys.get(kid)
+
+
+_jwks_caches = {}
+_validated_tokens = OrderedDict()
+_validated_lock = threading.Lock()
+# Discovered OpenID configuration of the OIDC provider: (time of the last attempt, document)
+_discovery = (0.0, None)
+_discovery_lock = threading.Lock()
+
+
+def discover_provider(config):
+    """Return the OpenID configuration of the OIDC provider, discovered at the
+    origin of its authorization endpoint, or None if it isn't available.
+
+    The document must list the configured authorization endpoint, so that the
+    issuer and JWKS endpoint it names are those of the configured provider.
+    """
+    global _discovery
+    attempted, document = _discovery
+    if document is not None or time.time() - attempted < DISCOVERY_RETRY_INTERVAL:
+        return document
+    with _discovery_lock:
+        attempted, document = _discovery
+        if document is not None or time.time() - attempted < DISCOVERY_RETRY_INTERVAL:
+            return document
+        endpoint = config.get('OIDC_AUTHORIZATION_ENDPOINT')
+        try:
+            if not endpoint:
+                raise ValueError("OIDC_AUTHORIZATION_ENDPOINT is not set")
+            url = urlsplit(endpoint)
+            r = requests.get(f"{url.scheme}://{url.netloc}/.well-known/openid-configuration", timeout=JWKS_TIMEOUT)
+            r.raise_for_status()
+            document = r.json()
+            if document.get('authorization_endpoint') != endpoint:
+                raise ValueError("its authorization endpoint is not the configured one")
+            if not document.get('issuer') or not document.get('jwks_uri'):
+                raise ValueError("it has no issuer or jwks_uri")
+        except (requests.RequestException, ValueError) as e:
+            document = None
+            print(f"WARNING: OIDC_ISSUER is not set and the OIDC provider's configuration could not be discovered ({e}); "
+                  "ID tokens are not validated locally, so user profiles are refreshed from the userinfo endpoint")
+        _discovery = (time.time(), document)
+        return document
+
+
+def get_jwks_cache(config):
+    """Signing keys of the OIDC provider, whose issuer and JWKS endpoint are
+    configured or else discovered (see discover_provider())."""
+    key = (config.get('OIDC_JWKS_URI'), config.get('OIDC_ISSUER'))
+    if not any(key):
+        document = discover_provider(config)
+        if document is not None:
+            key = (document['jwks_uri'], document['issuer'])
+    cache = _jwks_caches.get(key)
+    if cache is None:
+        cache = _jwks_caches.setdefault(key, JwksCache(*key, ttl=config.get('OIDC_JWKS_TTL', 3600)))
+    return cache
+
+
+def validate_id_token(config, id_token):
+    """Validate an ID token locally (signature, audience, issuer and expiry)
+    and return its claims, or None if it isn't valid (anymore).
+
+    The signature of a token is only verified once per process; after that,
+    only its expiry is checked.
+    """
+    if not id_token:
+        return None
+    now = time.time()
+    with _validated_lock:
+        claims = _validated_tokens.get(id_token)
+    if claims is None:
+        jwks = get_jwks_cache(config)
+        try:
+            header = jwt.get_unverified_header(id_token)
+            key = jwks.get_key(header.get('kid'))
+            if key is None:
+                return None
+            options = {'require': ['exp', 'iat', 'sub']}
+            if not jwks.issuer:
+                options['verify_iss'] = False
+            claims = jwt.decode(
+                id_token,
+                key.key,
+                algorithms=[key.algorithm_name or header.get('alg')],
+                audience=config['OIDC_CLIENT_ID'],
+                issuer=jwks.issuer,
+                leeway=ID_TOKEN_LEEWAY,
+                options=options,
+            )
+        except jwt.PyJWTError as e:
+            print(f"Invalid ID token: {e}")
+            return None
+        with _validated_lock:
+            _validated_tokens[id_token] = claims
+            while len(_validated_tokens) > VALIDATED_TOKENS_SIZE:
+                _validated_tokens.popitem(last=False)
+    if claims['exp'] + ID_TOKEN_LEEWAY < now:
+        return None
+    return claims
+
+
+def store_user_profile(config, user_info):
+    """Cache the user's profile claims in the session, until the profile TTL
+    passed or the ID token expires, whichever comes first."""
+    expires = time.time() + config.get('OIDC_PROFILE_TTL', 900)
+    claims = validate_id_token(config, session.get('id_token')) if get_jwks_cache(config).configured else None
+    if claims is not None:
+        expires = min(expires, claims['exp'])
+    session['user_profile'] = user_info
+    session['user_profile_expires'] = expires
+
+
+def get_user_profile(config):
+    """Return the user's profile claims.
+
+    Claims cached in the session are used while they are fresh and the ID
+    token stored in the session validates locally (against the provider's
+    cached signing keys); otherwise they are refreshed from the userinfo
+    endpoint with the access token.
+    """
+    profile = session.get('user_profile')
+    if profile and time.time() < session.get('user_profile_expires', 0):
+        if not get_jwks_cache(config).configured:
+            return profile
+        claims = validate_id_token(config, session.get('id_token'))
+        if claims is not None and claims['sub'] == profile.get('sub', claims['sub']):
+            return profile
+    user_info = get_user_info(config, session.get('access_token'))
+    if user_info:
+        store_user_profile(config, user_info)
+    return user_info
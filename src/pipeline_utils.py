@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Stages of the metadata updater, and the outputs it derives from the merged
+# metadata once per update (instead of on the request path)
+import hashlib
+import time
+from contextlib import contextmanager
+
+from cache_utils import (
+    ENCODED_EXTENSIONS,
+    compress_body,
+    encode,
+    encoded_name,
+)
+
+# Version of the derived outputs: bump it when a derivation changes, so that
+# outputs derived by a previous version of the updater are rebuilt
+DERIVE_VERSION = 1
+# Brotli quality of precompressed files; higher than on the request path, as
+# compressing happens once per update
+PRECOMPUTE_BROTLI_QUALITY = 11
+
+
+class Pipeline:
+    """Named stages of an update run, with the wall-clock time spent in each.
+
+    Stages may be entered more than once (e.g. filter and merge run per
+    streamed session), in which case their time accumulates.
+    """
+
+    def __init__(self, stages):
+        self.timings = dict.fromkeys(stages, 0.0)
+        self.skipped = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def timed(self, name, iterable):
+        """Iterate, counting the time spent producing each item towards a stage."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def skip(self, name, reason):
+        self.skipped[name] = reason
+
+    def report(self):
+        print("Pipeline stages:")
+        for name, seconds in self.timings.items():
+            if name in self.skipped:
+                print(f"\t{name}: skipped, {self.skipped[name]} ({seconds:.3f}s)")
+            else:
+                print(f"\t{name}: {seconds:.3f}s")
+
+
+class Derivation:
+    """Files derived from metadata files of a snapshot.
+
+    build(snapshot, load) writes the derived files to the snapshot and returns
+    their names; load(name) returns the parsed content of an input file. The
+    files are only rebuilt when the content hash of an input changed, and are
+    carried over from the previous snapshot otherwise.
+    """
+
+    def __init__(self, name, inputs, build):
+        self.name = name
+        self.inputs = inputs
+        self.build = build
+
+    def inputs_hash(self, snapshot):
+        h = hashlib.sha256(f"{DERIVE_VERSION}:{self.name}".encode('utf-8'))
+        for name in self.inputs:
+            h.update(f"\0{name}\0{snapshot.files[name]}".encode('utf-8'))
+        return h.hexdigest()
+
+
+def derive(snapshot, derivations, load):
+    """Build (or carry over) the derived outputs of a snapshot; returns the
+    names of the outputs that were rebuilt."""
+    built = []
+    for derivation in derivations:
+        # E.g. no file-level metadata was ever shared
+        if any(name not in snapshot.files for name in derivation.inputs):
+            continue
+        inputs = derivation.inputs_hash(snapshot)
+        if snapshot.reuse_derived(derivation.name, inputs):
+            continue
+        start = time.perf_counter()
+        snapshot.add_derived(derivation.name, inputs, derivation.build(snapshot, load))
+        print(f"\tDerived {derivation.name} in {time.perf_counter() - start:.3f}s")
+        built.append(derivation.name)
+    return built
+
+
+def write_encodings(snapshot, name, data):
+    """Write a metadata file encoded as every supported media type, and
+    compressed with every content coding; returns the names of the files.
+
+    The metadata file itself is indented JSON, so for JSON only the compressed
+    variants (of the compact body that the API serves) are written.
+    """
+    names = []
+    for mimetype in ENCODED_EXTENSIONS:
+        body = encode(data, mimetype)
+        variants = compress_body(body, brotli_quality=PRECOMPUTE_BROTLI_QUALITY)
+        if mimetype != 'application/json':
+            variants['identity'] = body
+        for encoding, variant in variants.items():
+            encoded = encoded_name(name, mimetype, encoding)
+            with open(snapshot.path(encoded), 'wb') as f:
+                f.write(variant)
+            names.append(encoded)
+    return names
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Reference data (providers, data users, projects) fetched from Neptune by the
+# metadata updater, indexed for preparing data request sessions
+
+METADATA_PROJECT = "GUTS-Metadata"
+SRAM_PROVIDER = "sram"
+REVIEWER_ROLE = "reviewer"
+
+
+class ReferenceRegistry:
+    """Indexes over the reference data files, built once per published version.
+
+    - providers by (Neptune) friendly name, with their first endpoint
+    - the GUTS-Metadata project, its service account per provider id, and
+      the ids of its members that are reviewers (in project member order)
+    """
+
+    def __init__(self, providers, data_users, projects):
+        self.providers = {p["friendly_name"]: p for p in reversed(providers)}
+        self.endpoints = {
+            name: next(iter(p.get("endpoints") or []), None)
+            for name, p in self.providers.items()
+        }
+        self.project = next((p for p in projects if p["name"] == METADATA_PROJECT), None)
+        self.service_accounts = {}
+        self.reviewers = []
+        if self.project is not None:
+            self.service_accounts = {
+                provider_id: account_id
+                for account_id, provider_id in self.project["service_accounts"].items()
+            }
+            reviewers = {}
+            for user in data_users:
+                if user["role"] == REVIEWER_ROLE:
+                    reviewers[user["_id"]] = reviewers.get(user["_id"], 0) + 1
+            self.reviewers = [
+                member for member in self.project["members"]
+                for _ in range(reviewers.get(member, 0))
+            ]
+
+    def provider(self, friendly_name):
+        return self.providers.get(friendly_name)
+
+    def endpoint(self, friendly_name):
+        """First endpoint of a provider (None if it has none)."""
+        return self.endpoints.get(friendly_name)
+
+    def service_account(self, provider_id):
+        """Id of the project's service account for a provider."""
+        return self.service_accounts[provider_id]
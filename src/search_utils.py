@@ -0,0 +1,217 @@
+import html
+import math
+import re
+import unicodedata
+from bisect import bisect_left
+from flask import abort
+
+# Searchable fields of the measure overview, with their BM25F weights
+FIELD_WEIGHTS = {
+    'short_name': 3.0,
+    'abbreviation': 3.0,
+    'long_name': 2.5,
+    'subscale': 1.5,
+    'data_category': 1.0,
+    'data_type': 1.0,
+    'description': 1.0,
+    'instruction': 0.5,
+    'scoring': 0.5,
+}
+# Facets of the measure overview that search results can be filtered on
+FACET_FIELDS = ['cohort', 'data_type', 'data_category']
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Score factor for terms that only match a query token as a prefix
+PREFIX_FACTOR = 0.7
+MAX_PREFIX_EXPANSIONS = 50
+SNIPPET_LENGTH = 160
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 200
+
+_word = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(text):
+    """Lowercase text and strip diacritics, e.g. 'Één' -> 'een'."""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return _word.findall(normalize(str(text)))
+
+
+def split_list(value):
+    """Split a packed, comma-separated field such as 'A,B' into its values."""
+    if not value:
+        return []
+    return [v.strip() for v in str(value).split(',') if v.strip()]
+
+
+def build_search_tables(measures):
+    """Postings, document lengths and word spans of the measure overview records.
+
+    These only depend on the measure overview file, so the updater precomputes
+    them (as JSON) for every published version of it.
+    """
+    postings = {}
+    lengths = []
+    # Per document and field: (start, end, term) of each word, for highlighting
+    spans = []
+    for doc, measure in enumerate(measures):
+        frequencies = {}
+        length = 0.0
+        doc_spans = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            text = measure.get(field)
+            if not text:
+                continue
+            words = [(m.start(), m.end(), normalize(m.group())) for m in _word.finditer(str(text))]
+            doc_spans[field] = words
+            length += weight * len(words)
+            for _, _, token in words:
+                frequencies[token] = frequencies.get(token, 0.0) + weight
+        spans.append(doc_spans)
+        for term, frequency in frequencies.items():
+            postings.setdefault(term, []).append((doc, frequency))
+        lengths.append(length)
+    return {'postings': postings, 'lengths': lengths, 'spans': spans}
+
+
+class SearchIndex:
+    """Inverted index over the measure overview with BM25F ranking.
+
+    Postings map each term to the documents containing it, together with the
+    field-weighted term frequency; a sorted term list supports prefix queries.
+    """
+
+    def __init__(self, overview, tables=None):
+        self.overview = overview
+        self.measures = [m.record for m in overview.measures]
+        measures = self.measures
+        if tables is None or len(tables['lengths']) != len(measures):
+            tables = build_search_tables(measures)
+        self.postings = tables['postings']
+        self.lengths = tables['lengths']
+        self.spans = tables['spans']
+        self.terms = sorted(self.postings)
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        self.idf = {
+            term: math.log(1 + (len(measures) - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self.postings.items()
+        }
+
+    def expand(self, token):
+        """Index terms matching a query token: the token itself and terms it is a prefix of."""
+        matches = {}
+        if token in self.postings:
+            matches[token] = 1.0
+        i = bisect_left(self.terms, token)
+        while i < len(self.terms) and len(matches) < MAX_PREFIX_EXPANSIONS:
+            term = self.terms[i]
+            if not term.startswith(token):
+                break
+            matches.setdefault(term, PREFIX_FACTOR)
+            i += 1
+        return matches
+
+    def filter_docs(self, facets):
+        """Documents matching the facet filters (any value within, all facets across),
+        using the reverse indexes of the measure overview model."""
+        docs = None
+        for facet, values in facets.items():
+            if not values:
+                continue
+            matching = set()
+            for value in values:
+                matching.update(m.position for m in self.overview.lookup(facet, self.overview.resolve(facet, value)))
+            docs = matching if docs is None else docs & matching
+        return docs
+
+    def search(self, query, facets=None, limit=DEFAULT_LIMIT):
+        """Return (total number of hits, ranked hits) for a query.
+
+        Every query token must match (as a whole word or as a prefix).
+        """
+        allowed = self.filter_docs(facets or {})
+        tokens = tokenize(query)
+        scores = None
+        matched_terms = set()
+        for token in tokens:
+            token_scores = {}
+            for term, factor in self.expand(token).items():
+                matched_terms.add(term)
+                idf = self.idf[term]
+                for doc, frequency in self.postings[term]:
+                    if allowed is not None and doc not in allowed:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc] / self.average_length)
+                    score = factor * idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+                    token_scores[doc] = max(token_scores.get(doc, 0.0), score)
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {d: s + token_scores[d] for d, s in scores.items() if d in token_scores}
+        if scores is None:
+            # No query terms: list all (facet-filtered) measures
+            docs = sorted(allowed) if allowed is not None else range(len(self.measures))
+            scores = {doc: 0.0 for doc in docs}
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        hits = [
+            {
+                'measure': self.measures[doc],
+                'score': round(score, 4),
+                'highlights': self.highlight(doc, matched_terms),
+            }
+            for doc, score in ranked[:limit]
+        ]
+        return len(ranked), hits
+
+    def highlight(self, doc, terms):
+        """Snippets of the fields of a document that contain matched terms, marked
+        with <mark>; the snippet text itself is HTML-escaped."""
+        if not terms:
+            return {}
+        highlights = {}
+        for field, words in self.spans[doc].items():
+            spans = [(s, e) for s, e, term in words if term in terms]
+            if not spans:
+                continue
+            text = str(self.measures[doc][field])
+            start = max(0, spans[0][0] - SNIPPET_LENGTH // 4)
+            end = min(len(text), start + SNIPPET_LENGTH)
+            parts = ['…' if start > 0 else '']
+            position = start
+            for s, e in spans:
+                if s < start or e > end:
+                    continue
+                parts += [html.escape(text[position:s]), '<mark>', html.escape(text[s:e]), '</mark>']
+                position = e
+            parts += [html.escape(text[position:end]), '…' if end < len(text) else '']
+            highlights[field] = ''.join(parts)
+        return highlights
+
+
+def search_measures(index, args):
+    """Search the measure overview with the request's query parameters."""
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        abort(400, description="Query parameter 'limit' must be a number.")
+    if limit < 1 or limit > MAX_LIMIT:
+        abort(400, description=f"Query parameter 'limit' must be between 1 and {MAX_LIMIT}.")
+    facets = {}
+    for facet in FACET_FIELDS:
+        values = []
+        for arg in args.getlist(facet):
+            values += split_list(arg)
+        facets[facet] = values
+    query = args.get('q', '')
+    total, hits = index.search(query, facets, limit)
+    return {
+        'query': query,
+        'total': total,
+        'hits': hits,
+    }
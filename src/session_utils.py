@@ -0,0 +1,213 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import (
+    SessionInterface,
+    SessionMixin,
+)
+from werkzeug.datastructures import CallbackDict
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session whose data is kept on the server; the cookie only holds its id."""
+
+    def __init__(self, sid, initial=None, new=False, remaining=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Seconds until the stored session expires (None for a new session)
+        self.remaining = remaining
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Move the session to a new id (e.g. after login, against session fixation)."""
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = new_session_id()
+        self.modified = True
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+class MemorySessionStore:
+    """Sessions in the memory of a single process: an LRU of at most
+    max_entries sessions, each expiring 'lifetime' seconds after it was saved."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        """Return (data, expires) of a session, or None if it doesn't exist or expired."""
+        with self._lock:
+            item = self._sessions.get(sid)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                del self._sessions[sid]
+                return None
+            self._sessions.move_to_end(sid)
+            return serializer.loads(item[0]), item[1]
+
+    def set(self, sid, data, lifetime):
+        with self._lock:
+            self._sessions[sid] = (serializer.dumps(data), time.time() + lifetime)
+            self._sessions.move_to_end(sid)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def evict_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (_, expires) in self._sessions.items() if expires < now]
+            for sid in expired:
+                del self._sessions[sid]
+        return len(expired)
+
+
+class SqliteSessionStore:
+    """Sessions in a local SQLite database, shared by all worker processes."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        db = self._connect()
+        db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def _connect(self):
+        """SQLite connection of the current thread (and process)."""
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def get(self, sid):
+        row = self._connect().execute(
+            "SELECT data, expires FROM sessions WHERE id = ? AND expires >= ?", (sid, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return serializer.loads(row[0]), row[1]
+
+    def set(self, sid, data, lifetime):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+            (sid, serializer.dumps(data), time.time() + lifetime),
+        )
+
+    def delete(self, sid):
+        self._connect().execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def evict_expired(self):
+        return self._connect().execute("DELETE FROM sessions WHERE expires < ?", (time.time(),)).rowcount
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface that keeps session data in a server-side store.
+
+    The cookie carries an opaque random id only, so it stays small and needs
+    no signature verification, and sessions can be ended on the server.
+    Sessions expire 'lifetime' seconds after they were last saved; sessions
+    that are used but not modified are extended once half their lifetime
+    passed. Expired sessions are evicted by a background thread.
+    """
+
+    def __init__(self, store, lifetime=8 * 3600, evict_interval=300):
+        self.store = store
+        self.lifetime = lifetime
+        self.evict_interval = evict_interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start_evictor(self):
+        """Start the eviction thread of this process, if not running yet."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._evict, name="session-evictor", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _evict(self):
+        while True:
+            time.sleep(self.evict_interval)
+            try:
+                self.store.evict_expired()
+            except Exception as e:
+                print(f"Failed to evict expired sessions: {e}")
+
+    def open_session(self, app, request):
+        self._start_evictor()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self.store.get(sid)
+            if stored is not None:
+                data, expires = stored
+                return ServerSession(sid, data, remaining=expires - time.time())
+        return ServerSession(new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified or session.previous_sid is not None:
+                # The session was cleared (e.g. on logout): end it on the server
+                if not session.new:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        response.vary.add('Cookie')
+        refresh = session.remaining is not None and session.remaining < self.lifetime / 2
+        if not (session.modified or session.new or refresh):
+            return
+        self.store.set(session.sid, dict(session), self.lifetime)
+        response.set_cookie(
+            name,
+            session.sid,
+            max_age=self.lifetime if session.permanent else None,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def create_session_interface(config, repo_path):
+    """Session interface for the configured backend ('memory', 'sqlite' or
+    'cookie'); None keeps Flask's signed cookie sessions."""
+    backend = config['SESSION_BACKEND']
+    if backend == 'cookie':
+        return None
+    if backend == 'memory':
+        store = MemorySessionStore(config['SESSION_MAX_ENTRIES'])
+    elif backend == 'sqlite':
+        store = SqliteSessionStore(repo_path / config['SESSION_SQLITE_PATH'])
+    else:
+        raise ValueError(f"Unknown session backend: {backend}. Options: memory, sqlite, cookie")
+    return ServerSessionInterface(store, lifetime=config['SESSION_LIFETIME'])
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Name of the symlink pointing to the current snapshot directory
+CURRENT = "current"
+MANIFEST = "_manifest.json"
+
+
+def _fsync_path(path, directory=False):
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Snapshot:
+    """A published, immutable version of the merged metadata files."""
+    __slots__ = ('version', 'path', 'manifest')
+
+    def __init__(self, version, path, manifest):
+        self.version = version
+        self.path = path
+        self.manifest = manifest
+
+    @property
+    def files(self):
+        return self.manifest.get('files', {})
+
+    @property
+    def derived(self):
+        """Derived outputs of the snapshot: their input hash and files."""
+        return self.manifest.get('derived', {})
+
+    def file_path(self, name):
+        """Path of a file in this snapshot, or None if the snapshot doesn't have it."""
+        if name not in self.files:
+            return None
+        return self.path / name
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def current_snapshot(root):
+    """Return the snapshot that the 'current' pointer refers to, or None.
+
+    Costs one readlink() per call; manifests are read once per version.
+    """
+    try:
+        version = os.readlink(Path(root) / CURRENT)
+    except (FileNotFoundError, OSError):
+        return None
+    return load_snapshot(root, version)
+
+
+def load_snapshot(root, version):
+    """Return a (current or previous) snapshot by version, or None if it
+    doesn't exist (anymore).
+
+    Manifests are cached per process until the writer prunes their snapshot
+    (see SnapshotWriter.publish()), so the cache holds at most the retained
+    versions, and pruned versions aren't served from it.
+    """
+    snapshot = _snapshots.get(version)
+    if snapshot is not None:
+        if snapshot.path.is_dir():
+            return snapshot
+        with _snapshots_lock:
+            _snapshots.pop(version, None)
+        return None
+    if not version or version.startswith('.') or '/' in version or version == CURRENT:
+        return None
+    path = Path(root) / version
+    try:
+        with open(path / MANIFEST, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    snapshot = Snapshot(version, path, manifest)
+    with _snapshots_lock:
+        _snapshots[version] = snapshot
+        for old in [v for v, s in _snapshots.items() if not s.path.is_dir()]:
+            _snapshots.pop(old, None)
+    return snapshot
+
+
+class SnapshotWriter:
+    """Write a new snapshot directory and atomically make it the current one.
+
+    Files are written into a hidden staging directory, which is fsynced and
+    renamed to its version name once complete. The 'current' symlink is then
+    replaced with os.replace(), so readers see either the previous or the new
+    snapshot, never a partially written one.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.previous = current_snapshot(self.root)
+        version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        suffix = 0
+        self.version = version
+        while (self.root / self.version).exists():
+            suffix += 1
+            self.version = f"{version}-{suffix}"
+        self.staging = self.root / f".{self.version}.partial"
+        self.staging.mkdir()
+        self.files = {}
+        self.derived = {}
+
+    def path(self, name):
+        """Path to write a file of the new snapshot to."""
+        return self.staging / name
+
+    def add(self, name):
+        """Register a file that was written to path(name)."""
+        self.files[name] = file_sha256(self.path(name))
+
+    def carry_over(self, name, fallback=None):
+        """Include an unchanged file from the previous snapshot (or from a fallback path).
+
+        Files are hard-linked where possible, so unchanged content is not copied.
+        """
+        source = self.previous.file_path(name) if self.previous else None
+        if source is None and fallback is not None and Path(fallback).exists():
+            source = Path(fallback)
+        if source is None:
+            return False
+        try:
+            os.link(source, self.path(name))
+        except OSError:
+            shutil.copy2(source, self.path(name))
+        if self.previous is not None and name in self.previous.files:
+            self.files[name] = self.previous.files[name]
+        else:
+            self.add(name)
+        return True
+
+    def reuse_derived(self, name, inputs):
+        """Carry over the files of a derived output from the previous snapshot,
+        if they were derived from the same inputs (by content hash)."""
+        previous = self.previous.derived.get(name) if self.previous else None
+        if previous is None or previous['inputs'] != inputs:
+            return False
+        if any(self.previous.file_path(f) is None for f in previous['files']):
+            return False
+        for f in previous['files']:
+            self.carry_over(f)
+        self.derived[name] = previous
+        return True
+
+    def add_derived(self, name, inputs, files):
+        """Register the files of a derived output, with the hash of its inputs."""
+        for f in files:
+            self.add(f)
+        self.derived[name] = {'inputs': inputs, 'files': list(files)}
+
+    def unchanged(self):
+        """Whether the snapshot has exactly the same files as the previous one."""
+        return self.previous is not None and self.files == self.previous.files
+
+    def publish(self, retention=5):
+        """Make the snapshot durable and switch the 'current' pointer to it."""
+        manifest = {
+            'version': self.version,
+            'previous': self.previous.version if self.previous else None,
+            'created': datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            'files': self.files,
+            'derived': self.derived,
+        }
+        with open(self.path(MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=4)
+        for name in list(self.files) + [MANIFEST]:
+            _fsync_path(self.path(name))
+        _fsync_path(self.staging, directory=True)
+        final = self.root / self.version
+        os.rename(self.staging, final)
+        tmp_link = self.root / f".{CURRENT}.tmp"
+        if tmp_link.is_symlink():
+            tmp_link.unlink()
+        os.symlink(self.version, tmp_link)
+        os.replace(tmp_link, self.root / CURRENT)
+        _fsync_path(self.root, directory=True)
+        self.prune(retention)
+        return final
+
+    def discard(self):
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+    def prune(self, retention):
+        """Remove all but the 'retention' most recent snapshots (always keeping the current one)."""
+        versions = sorted(
+            p.name for p in self.root.iterdir()
+            if p.is_dir() and not p.is_symlink() and not p.name.startswith('.')
+        )
+        for version in versions[:-retention] if retention > 0 else []:
+            if version != self.version:
+                shutil.rmtree(self.root / version, ignore_errors=True)
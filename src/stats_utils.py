@@ -0,0 +1,207 @@
+import math
+import os
+import numpy as np
+from flask import abort
+from matrix_utils import normalize_session
+from subject_utils import (
+    get_list_arg,
+    get_number_arg,
+)
+
+# Fields that availability counts can be grouped by
+GROUP_BY_FIELDS = ['cohort', 'session', 'sex', 'age_bin']
+DEFAULT_GROUP_BY = ['cohort', 'session']
+DEFAULT_AGE_BIN_WIDTH = 2
+# Number of distinct stats queries cached per loaded availability matrix
+STATS_CACHE_SIZE = 256
+
+
+class StatsCube:
+    """Availability counts aggregated per (cohort, session, sex, age) cell.
+
+    Each cell holds the number of subject-sessions in it, and per measure the
+    number of those with primary and with derivative data. Any group-by over
+    these fields is a roll-up of cells, so queries never touch subject rows.
+    """
+    __slots__ = ('cohorts', 'sessions', 'session_keys', 'sexes', 'ages',
+                 'subjects', 'primary', 'derivative', 'measures', 'measure_index')
+
+    def __init__(self, matrix, rows=None):
+        if rows is None:
+            rows = np.ones(len(matrix), dtype=bool)
+        ages = np.where(np.isnan(matrix.ages), -1.0, matrix.ages)
+        keys = list(zip(
+            matrix.cohorts[rows].tolist(),
+            matrix.session_keys[rows].tolist(),
+            matrix.sexes[rows].tolist(),
+            ages[rows].tolist(),
+        ))
+        cells = {}
+        inverse = np.array([cells.setdefault(k, len(cells)) for k in keys], dtype=np.intp)
+        # Session labels as they appear in the metadata, e.g. '02'
+        labels = {}
+        for key, session in zip(keys, matrix.sessions[rows].tolist()):
+            labels.setdefault(key, session)
+        cells = list(cells)
+        self.cohorts = np.array([c[0] for c in cells], dtype=str)
+        self.session_keys = np.array([c[1] for c in cells], dtype=str)
+        self.sessions = np.array([labels[c] for c in cells], dtype=str)
+        self.sexes = np.array([c[2] for c in cells], dtype=str)
+        self.ages = np.array([np.nan if c[3] < 0 else c[3] for c in cells], dtype=np.float64)
+        self.subjects = np.bincount(inverse, minlength=len(cells))
+        self.primary = np.zeros((len(cells), len(matrix.measures)), dtype=np.int32)
+        self.derivative = np.zeros((len(cells), len(matrix.measures)), dtype=np.int32)
+        np.add.at(self.primary, inverse, matrix.primary[rows] > 0)
+        np.add.at(self.derivative, inverse, matrix.derivative[rows] > 0)
+        self.measures = matrix.measures
+        self.measure_index = matrix.measure_index
+
+    # Arrays of the cube that are persisted; measures are those of the matrix
+    _ARRAYS = ('cohorts', 'session_keys', 'sessions', 'sexes', 'ages', 'subjects', 'primary', 'derivative')
+
+    @classmethod
+    def load(cls, path, matrix):
+        """Load a cube that was saved with StatsCube.save(), for the matrix it
+        was built from (or None if it doesn't fit that matrix)."""
+        cube = cls.__new__(cls)
+        with np.load(path, allow_pickle=False) as arrays:
+            for name in cls._ARRAYS:
+                setattr(cube, name, arrays[name])
+        if cube.primary.shape[1] != len(matrix.measures) or cube.subjects.sum() != len(matrix):
+            return None
+        cube.measures = matrix.measures
+        cube.measure_index = matrix.measure_index
+        return cube
+
+    def save(self, path):
+        """Write the cube to an (uncompressed) .npz file, replacing it atomically."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **{name: getattr(self, name) for name in self._ARRAYS})
+        os.replace(tmp_path, path)
+
+    def _labels(self, field, age_bin_width):
+        if field == 'cohort':
+            return self.cohorts
+        if field == 'session':
+            return self.sessions
+        if field == 'sex':
+            return self.sexes
+        lower = np.floor(self.ages / age_bin_width) * age_bin_width
+        return np.array([
+            'unknown' if math.isnan(lo) else f"{lo:g}-{lo + age_bin_width:g}"
+            for lo in lower.tolist()
+        ], dtype=str)
+
+    def rollup(self, group_by, cohort=None, session=None, sex=None, age_min=None,
+               age_max=None, measures=None, age_bin_width=DEFAULT_AGE_BIN_WIDTH):
+        """Cross-tabulate availability counts over the group-by fields."""
+        cells = np.ones(len(self.subjects), dtype=bool)
+        if cohort:
+            cells &= np.isin(self.cohorts, list(cohort))
+        if session:
+            cells &= np.isin(self.session_keys, list(session))
+        if sex:
+            cells &= np.isin(self.sexes, list(sex))
+        if age_min is not None:
+            cells &= self.ages >= age_min
+        if age_max is not None:
+            cells &= self.ages <= age_max
+        cells = np.flatnonzero(cells)
+        if measures:
+            columns = [self.measure_index[m] for m in measures]
+        else:
+            columns = list(range(len(self.measures)))
+        names = [self.measures[c] for c in columns]
+
+        labels = [self._labels(field, age_bin_width)[cells].tolist() for field in group_by]
+        groups = {}
+        inverse = np.array(
+            [groups.setdefault(key, len(groups)) for key in zip(*labels)] if group_by
+            else [0] * len(cells),
+            dtype=np.intp,
+        )
+        n_groups = len(groups) if group_by else 1
+        subjects = np.bincount(inverse, weights=self.subjects[cells], minlength=n_groups)
+        primary = np.zeros((n_groups, len(columns)), dtype=np.int64)
+        derivative = np.zeros((n_groups, len(columns)), dtype=np.int64)
+        np.add.at(primary, inverse, self.primary[np.ix_(cells, columns)])
+        np.add.at(derivative, inverse, self.derivative[np.ix_(cells, columns)])
+
+        keys = sorted(groups, key=groups.get) if group_by else [()] * n_groups
+        result = []
+        for g, key in enumerate(keys):
+            group = dict(zip(group_by, key))
+            group['subjects'] = int(subjects[g])
+            group['primary'] = dict(zip(names, primary[g].tolist()))
+            group['derivative'] = dict(zip(names, derivative[g].tolist()))
+            result.append(group)
+        result.sort(key=lambda g: tuple(_sort_key(f, g[f]) for f in group_by))
+        return result
+
+
+def _sort_key(field, label):
+    """Sort age bins numerically and all other labels alphabetically."""
+    if field == 'age_bin':
+        return (0, float(label.split('-')[0])) if label != 'unknown' else (1, 0.0)
+    return (0, label)
+
+
+def parse_stats_query(args, matrix):
+    """Validate the query parameters of a stats request, as a hashable tuple."""
+    group_by = get_list_arg(args, 'group_by') if 'group_by' in args else DEFAULT_GROUP_BY
+    unknown = [f for f in group_by if f not in GROUP_BY_FIELDS]
+    if unknown:
+        abort(400, description=f"Cannot group by: {', '.join(unknown)}. Options: {', '.join(GROUP_BY_FIELDS)}")
+    measures = get_list_arg(args, 'measure')
+    has_primary = get_list_arg(args, 'has_primary')
+    has_derivative = get_list_arg(args, 'has_derivative')
+    unknown = [m for m in measures + has_primary + has_derivative if m not in matrix.measure_index]
+    if unknown:
+        abort(400, description=f"Unknown measure(s): {', '.join(unknown)}")
+    age_bin_width = get_number_arg(args, 'age_bin')
+    if age_bin_width is None:
+        age_bin_width = DEFAULT_AGE_BIN_WIDTH
+    elif age_bin_width <= 0:
+        abort(400, description="Query parameter 'age_bin' must be positive.")
+    return (
+        tuple(dict.fromkeys(group_by)),
+        frozenset(get_list_arg(args, 'cohort')),
+        frozenset(get_list_arg(args, 'session')),
+        frozenset(s.lower() for s in get_list_arg(args, 'sex')),
+        get_number_arg(args, 'age_min'),
+        get_number_arg(args, 'age_max'),
+        tuple(measures),
+        tuple(has_primary),
+        tuple(has_derivative),
+        age_bin_width,
+    )
+
+
+def compute_stats(matrix, cube, query):
+    """Compute cross-tabulated availability counts for a parsed stats query.
+
+    Queries that only filter on group-by fields are rolled up from the
+    precomputed cube; filtering on data availability needs a cube built from
+    the matching subject-sessions.
+    """
+    (group_by, cohort, session, sex, age_min, age_max,
+     measures, has_primary, has_derivative, age_bin_width) = query
+    session = {normalize_session(s) for s in session}
+    if has_primary or has_derivative:
+        cube = StatsCube(matrix, matrix.mask(has_primary=has_primary, has_derivative=has_derivative))
+    groups = cube.rollup(
+        list(group_by),
+        cohort=cohort,
+        session=session,
+        sex=sex,
+        age_min=age_min,
+        age_max=age_max,
+        measures=list(measures),
+        age_bin_width=age_bin_width,
+    )
+    return {
+        'group_by': list(group_by),
+        'age_bin': age_bin_width if 'age_bin' in group_by else None,
+        'groups': groups,
+    }
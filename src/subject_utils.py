@@ -0,0 +1,159 @@
+import base64
+import json
+import math
+import numpy as np
+from flask import abort
+from matrix_utils import (
+    iter_measures,
+    normalize_session,
+)
+
+# Fields that identify a subject-session record; always included in query results
+SUBJECT_ID_FIELDS = ['subject', 'session', 'age', 'sex', 'cohort']
+# Query parameters understood by the subjects endpoint
+SUBJECT_QUERY_PARAMS = [
+    'cohort', 'session', 'sex', 'age_min', 'age_max',
+    'has_primary', 'has_derivative', 'fields', 'limit', 'cursor',
+]
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def get_measure(record, measure):
+    """Get the availability dict of a (possibly nested, e.g. 'demographics.age') measure."""
+    value = record
+    for part in measure.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def encode_cursor(record):
+    key = json.dumps([record['subject'], record['session']]).encode('utf-8')
+    return base64.urlsafe_b64encode(key).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        abort(400, description="Invalid cursor.")
+    if not isinstance(key, list) or len(key) != 2 or not all(isinstance(k, str) for k in key):
+        abort(400, description="Invalid cursor.")
+    subject, session = key
+    return subject, session
+
+
+def build_subject_index(entry):
+    """Index subject-level metadata by (subject, session) and list the known measures."""
+    records = entry.data
+    positions = {}
+    measures = set()
+    for i, record in enumerate(records):
+        positions[(record['subject'], record['session'])] = i
+        measures.update(m for m, _ in iter_measures(record))
+        if isinstance(record.get('demographics'), dict):
+            measures.add('demographics')
+    return {
+        'records': records,
+        'positions': positions,
+        'measures': measures,
+    }
+
+
+def get_list_arg(args, name):
+    """Get a multi-valued query parameter, given as repeated and/or comma-separated values."""
+    values = []
+    for arg in args.getlist(name):
+        values += [v.strip() for v in arg.split(',') if v.strip()]
+    return values
+
+
+def get_number_arg(args, name, cast=float):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        number = cast(value)
+    except ValueError:
+        abort(400, description=f"Query parameter '{name}' must be a number.")
+    # float() also accepts 'nan' and 'inf', which compare and bin meaninglessly
+    if not math.isfinite(number):
+        abort(400, description=f"Query parameter '{name}' must be a finite number.")
+    return number
+
+
+def parse_subject_query(args, measures, matrix):
+    """Validate the query parameters of a subjects request."""
+    query = {
+        'cohort': set(get_list_arg(args, 'cohort')),
+        'session': {normalize_session(s) for s in get_list_arg(args, 'session')},
+        'sex': {s.lower() for s in get_list_arg(args, 'sex')},
+        'age_min': get_number_arg(args, 'age_min'),
+        'age_max': get_number_arg(args, 'age_max'),
+        'has_primary': get_list_arg(args, 'has_primary'),
+        'has_derivative': get_list_arg(args, 'has_derivative'),
+        'fields': get_list_arg(args, 'fields') if 'fields' in args else None,
+        'limit': get_number_arg(args, 'limit', int),
+        'cursor': decode_cursor(args['cursor']) if args.get('cursor') else None,
+    }
+    unknown = [m for m in query['fields'] or [] if m not in measures] + [
+        m for m in query['has_primary'] + query['has_derivative']
+        if m not in matrix.measure_index
+    ]
+    if unknown:
+        abort(400, description=f"Unknown measure(s): {', '.join(unknown)}")
+    if query['limit'] is None:
+        query['limit'] = DEFAULT_PAGE_SIZE
+    elif query['limit'] < 1 or query['limit'] > MAX_PAGE_SIZE:
+        abort(400, description=f"Query parameter 'limit' must be between 1 and {MAX_PAGE_SIZE}.")
+    return query
+
+
+def project_subject(record, fields):
+    """Return a record restricted to the identifying fields plus the requested measures."""
+    if fields is None:
+        return record
+    projected = {k: record[k] for k in SUBJECT_ID_FIELDS if k in record}
+    for field in fields:
+        if field.startswith('demographics.'):
+            projected.setdefault('demographics', {})[field.split('.', 1)[1]] = get_measure(record, field)
+        else:
+            projected[field] = record.get(field)
+    return projected
+
+
+def query_subjects(index, matrix, query):
+    """Return one page of subject-level records matching a query.
+
+    Filters are evaluated as vectorized operations on the availability matrix;
+    only the records on the requested page are looked up and projected.
+    """
+    mask = matrix.mask(
+        cohort=query['cohort'],
+        session=query['session'],
+        sex=query['sex'],
+        age_min=query['age_min'],
+        age_max=query['age_max'],
+        has_primary=query['has_primary'],
+        has_derivative=query['has_derivative'],
+    )
+    start = 0
+    if query['cursor'] is not None:
+        row = matrix.row_index.get(query['cursor'])
+        if row is None:
+            abort(400, description="Invalid or expired cursor.")
+        start = row + 1
+    rows = np.flatnonzero(mask[start:])[:query['limit'] + 1] + start
+    keys = [(matrix.subjects[r], matrix.sessions[r]) for r in rows[:query['limit']].tolist()]
+    items = [index['records'][index['positions'][k]] for k in keys if k in index['positions']]
+    next_cursor = None
+    if len(rows) > query['limit'] and items:
+        next_cursor = encode_cursor(items[-1])
+    return {
+        'items': [project_subject(r, query['fields']) for r in items],
+        'total': int(mask.sum()),
+        'limit': query['limit'],
+        'next_cursor': next_cursor,
+    }
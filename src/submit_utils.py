@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+from pathlib import Path
+
+from werkzeug.exceptions import HTTPException
+
+from config import Config
+from job_utils import (
+    JobQueue,
+    JobWorkers,
+    PermanentJobError,
+)
+from msgraph_utils import (
+    email_body,
+    mail_service,
+)
+from neptune_utils import (
+    NeptuneRequestError,
+    create_neptune_data_request,
+)
+
+repo_path = Path(__file__).resolve().parent.parent
+DATA_REQUEST = "data_request"
+# Neptune responses that may succeed when the request is repeated
+RETRYABLE_STATUS_CODES = {408, 425, 429}
+# Seconds to wait for the mail service to send a confirmation email
+MAIL_TIMEOUT = 120
+
+
+def send_confirmation_email(user_data, receipt):
+    """Send the data request confirmation email, with the receipt attached,
+    through the shared mail service (which batches concurrent messages)."""
+    name = user_data.get("name", "applicant")
+    mail_service.send(email_body.format(name=name), user_data["email"], receipt).result(timeout=MAIL_TIMEOUT)
+
+
+def process_data_request(job):
+    """Submit a data request to Neptune, then send the confirmation email.
+
+    Completed steps are saved with the job, so a retry after a failed email
+    doesn't submit the request to Neptune again.
+    """
+    data = job.payload
+    if "neptune" not in job.progress:
+        try:
+            r = create_neptune_data_request(data)
+        except NeptuneRequestError as e:
+            if e.status_code < 500 and e.status_code not in RETRYABLE_STATUS_CODES:
+                raise PermanentJobError(str(e))
+            raise
+        except (ValueError, KeyError, HTTPException) as e:
+            # Building the session failed, e.g. for an unknown provider, a
+            # provider without a service account or missing reference files:
+            # retrying won't fix the request
+            raise PermanentJobError(f"{type(e).__name__}: {e}")
+        # The request was submitted: record that even if the response isn't
+        # JSON, so that a retry doesn't submit it again
+        try:
+            response = r.json()
+        except ValueError:
+            response = {"status_code": r.status_code, "body": r.text}
+        job.save("neptune", response)
+    if "email" not in job.progress:
+        if not data["user_data"].get("email"):
+            job.save("email", {"sent": False})
+            return
+        receipt = {
+            "provider": data["provider_friendly"],
+            "request": data["form_data"],
+            "directories": data.get("directories", []),
+            "prefixes": data.get("prefixes", []),
+            "number_of_files": len(data["file_paths"]),
+        }
+        send_confirmation_email(data["user_data"], receipt)
+        job.save("email", {"sent": True})
+
+
+# Durable queue of submitted data requests, processed by background workers
+job_queue = JobQueue(repo_path / Config.JOB_QUEUE_PATH)
+job_workers = JobWorkers(
+    job_queue,
+    {DATA_REQUEST: process_data_request},
+    workers=Config.JOB_WORKERS,
+    lease=Config.JOB_LEASE_SECONDS,
+    base_delay=Config.JOB_RETRY_BASE_DELAY,
+    max_delay=Config.JOB_RETRY_MAX_DELAY,
+)
+
+
+def submit_data_request(incoming_data, owner):
+    """Queue a data request for submission and return its job id."""
+    job_id = job_queue.enqueue(DATA_REQUEST, incoming_data, owner=owner, max_attempts=Config.JOB_MAX_ATTEMPTS)
+    job_workers.start()
+    job_workers.notify()
+    return job_id
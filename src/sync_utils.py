@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+FILE_LEVEL = "file-level-metadata"
+SUBJECT_LEVEL = "subject-level-metadata"
+MEASURE_OVERVIEW = "measure-overview"
+META_TYPES = [FILE_LEVEL, SUBJECT_LEVEL, MEASURE_OVERVIEW]
+# Candidate fields holding the path of a file-level metadata record
+FILE_PATH_FIELDS = ["path", "file_path", "filepath", "file"]
+# Candidate fields holding the size (in bytes) of a file-level metadata record
+FILE_SIZE_FIELDS = ["size", "file_size", "filesize", "bytes"]
+
+
+def file_path(record):
+    """Return the path of a file-level metadata record, if it has one."""
+    return next((record[f] for f in FILE_PATH_FIELDS if record.get(f)), None)
+
+
+def file_size(record):
+    """Return the size in bytes of a file-level metadata record (0 if unknown)."""
+    for f in FILE_SIZE_FIELDS:
+        try:
+            return int(record[f])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return 0
+
+
+def record_key(meta_type, record):
+    """Natural key of a metadata record, used to upsert records shared more than once.
+
+    - subject-level: subject + session
+    - file-level: provider + file path
+    - measure overview: measure short name + mapping id (short names are not
+      unique in the overview, e.g. the same measure listed per cohort)
+    Records without the expected fields are keyed by a hash of their content.
+    """
+    if meta_type == SUBJECT_LEVEL and record.get("subject") is not None:
+        return f"{record['subject']}|{record.get('session')}"
+    if meta_type == FILE_LEVEL and file_path(record) is not None:
+        return f"{record.get('explorer_provider')}|{file_path(record)}"
+    if meta_type == MEASURE_OVERVIEW and record.get("short_name") is not None:
+        if record.get("mapping"):
+            return f"{record['short_name']}|{record['mapping']}"
+        return record["short_name"]
+    content = json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def record_hash(record):
+    """Content hash of a metadata record."""
+    content = json.dumps(record, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()[:32]
+
+
+def record_hashes(meta_type, records):
+    """Content hash per record key of a metadata file, for computing changes between versions."""
+    return {record_key(meta_type, r): record_hash(r) for r in records}
+
+
+def keyed_contributions(contributions):
+    """Records that a session contributed by natural key, per metadata type;
+    of records with the same key within the session, the last one wins."""
+    return {
+        meta_type: {record_key(meta_type, r): r for r in records}
+        for meta_type, records in contributions.items()
+    }
+
+
+def hashes_file(name):
+    """Name of the record hashes file published next to a metadata file."""
+    return f"{name.rsplit('.', 1)[0]}.hashes.json"
+
+
+class MetadataStore:
+    """Persistent store of the metadata merged from provider share-sessions.
+
+    The store remembers every processed session (with its create_ts and the
+    keys of the records it contributed) and, per record key, the record as
+    contributed by each session, so an update only needs to process new or
+    changed sessions and can upsert their records into the complete merged
+    outputs. Since every contribution is kept, removing a session falls back
+    to the record of the next most recently created session sharing it.
+    """
+
+    def __init__(self, sessions=None, records=None):
+        self.sessions = sessions or {}
+        self.records = records or {t: {} for t in META_TYPES}
+        for t in META_TYPES:
+            self.records.setdefault(t, {})
+            for key, item in self.records[t].items():
+                # Stores written before contributors were tracked hold the winning record only
+                if "session" in item and "record" in item:
+                    self.records[t][key] = {item["session"]: {"create_ts": item["create_ts"], "record": item["record"]}}
+        self.changed = set()
+
+    @classmethod
+    def load(cls, path):
+        """Load the store from a JSON file; a missing store is empty."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        return cls(data.get("sessions"), data.get("records"))
+
+    def save(self, path):
+        """Write the store to a JSON file, replacing the previous one atomically."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"sessions": self.sessions, "records": self.records}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def is_processed(self, session):
+        """Whether a session was merged before and has not changed since."""
+        known = self.sessions.get(session["_id"])
+        return known is not None and known["create_ts"] == session["create_ts"]
+
+    def remove_session(self, session_id):
+        """Remove a session and its contributions; records that other sessions
+        share too remain, as contributed by those sessions."""
+        known = self.sessions.pop(session_id, None)
+        if known is None:
+            return
+        for meta_type, keys in known.get("keys", {}).items():
+            records = self.records[meta_type]
+            for key in keys:
+                contributors = records.get(key)
+                if contributors is None or contributors.pop(session_id, None) is None:
+                    continue
+                if not contributors:
+                    del records[key]
+                self.changed.add(meta_type)
+
+    def add_session(self, session, provider, contributions):
+        """Merge the records that a session contributed, by natural key per
+        metadata type (see keyed_contributions()).
+
+        Records are upserted by natural key; when several sessions share a
+        record, the one from the most recently created session wins. The
+        measure overview is shared as a whole, so only the overview of the
+        most recently created session is output (see output()).
+        """
+        session_id = session["_id"]
+        create_ts = session["create_ts"]
+        self.remove_session(session_id)
+        keys = {}
+        for meta_type, new_records in contributions.items():
+            records = self.records[meta_type]
+            for key, record in new_records.items():
+                records.setdefault(key, {})[session_id] = {"create_ts": create_ts, "record": record}
+            keys[meta_type] = list(new_records)
+            self.changed.add(meta_type)
+        self.sessions[session_id] = {
+            "_id": session_id,
+            "create_ts": create_ts,
+            "provider": provider,
+            "metadata_shared": list(contributions),
+            "keys": keys,
+            "updated": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        }
+
+    def output(self, meta_type):
+        """All merged records of a metadata type: per key, the record of the
+        most recently created session that contributed it (of sessions with
+        the same create_ts, the one merged last)."""
+        records = self.records[meta_type]
+        if meta_type == MEASURE_OVERVIEW:
+            latest = None
+            for contributors in records.values():
+                for session_id, item in contributors.items():
+                    if latest is None or item["create_ts"] >= latest[0]:
+                        latest = (item["create_ts"], session_id)
+            if latest is None:
+                return []
+            return [c[latest[1]]["record"] for c in records.values() if latest[1] in c]
+        output = []
+        for contributors in records.values():
+            winner = None
+            for item in contributors.values():
+                if winner is None or item["create_ts"] >= winner["create_ts"]:
+                    winner = item
+            output.append(winner["record"])
+        return output
+
+    def processed_sessions(self):
+        """Processed sessions in the format of the '_sessions.json' state file."""
+        return [
+            {k: v for k, v in s.items() if k != "keys"}
+            for s in self.sessions.values()
+        ]
+
+    def providers(self):
+        return sorted({s["provider"] for s in self.sessions.values() if s["provider"]})
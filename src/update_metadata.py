@@ -4,33 +4,38 @@
 # 
 # ASSUMPTIONS
 # -----------
-# Providers create a new session whenever new metadata is provided,
-# i.e. existing sessions are not updated/patched.
+# Providers create a new session whenever new metadata is provided.
+# Sessions that are re-created (new create_ts) or deactivated are handled
+# by the incremental sync: their previously merged records are replaced or removed.
 
 # CONFIG
 # ------
 # - A list of known provider friendly names (a.k.a. cohorts): ["eur", "lei", "vu", "aumc"]
 # - A list of known metadata types:
 #   ["guts-file-level-metadata", "guts-subject-level-metadata"]
-# - A list of session ids for which metadata has already been processed
-# - A list of session ids for which metadata has already been processed,
-#   assoctaied with a source site
-
-# STEPS
-# -----
-# 1: Get providers
-# ----------------
-# - Make an HTTP GET request to the "providers" endpoint, retrieving the list.
+# - A store of the sessions for which metadata has already been processed,
+#   associated with a source site, and of the records each session contributed
+
+# STAGES
+# ------
+# The update runs as a pipeline of stages: fetch, filter, merge, derive and
+# publish. The time spent in each stage is reported at the end of the run.
+#
+# 1: Fetch
+# --------
+# - Make HTTP GET requests to the "providers", "users/me", "data_users" and
+#   "projects" endpoints, concurrently.
 # - Isolate providers with known friendly names: providers[i]["friendly_name"]
 # - Get their endpoints, for matching with associated metadata profile later:
 #   providers[i]["endpoints"][j]["hostname"]
-# - Save list if different from previous
+# - Make an HTTP GET request to the “session” endpoint, streaming the list
+#   so that sessions are filtered and merged one at a time as they arrive.
 
-# 2: Get and filter sessions
-# --------------------------
-# - Make an HTTP GET request to the “session” endpoint, retrieving the list.
+# 2: Filter
+# ---------
 # - Filter down the list of sessions to those that can be used:
-#   - New id: sessions[i]["_id"] not in list of previously processed ids
+#   - New or changed: sessions[i]["_id"] not in the store of previously processed
+#     sessions, or with a different sessions[i]["create_ts"]
 #   - Active status: sessions[i]["status"] == "active"
 #   - Must have events: len(sessions[i]["events"]) > 0
 #   - Event operation must be type share: sessions[i]["events"][j]["operation"] == "share"
@@ -38,29 +43,80 @@
 #   - Metadata item must be of known types:
 #     sessions[i]["events"][j]["metadata"][k][0] == "json"
 #     sessions[i]["events"][j]["metadata"][k][1] in ["guts-file-level-metadata", "guts-subject-level-metadata"]
+# - Sessions that were processed before and did not change are skipped, so
+#   merging (and everything after it) is skipped when no session changed.
 
-# 3: Merge and save metadata
-# --------------------------
-# - Write new session ids and friendly names and time stamps to list:
+# 3: Merge
+# --------
+# - Write new session ids and friendly names and time stamps to the store:
 #   - id and time stamp directly from session
 #   - Get associated profile tag: tag = sessions[i]["events"][j]["profile_tags"]["path"]
 #   - Find associated profile: k where sessions[i]["events"][j]["profiles"][k]["tag"] == tag
 #   - Get associated hostname: hostname = sessions[i]["events"][j]["profiles"][k]["endpoint"]["hostname"]
 #   - Get associated friendly name from known list: providers["hostname"] == hostname
+#   (profiles are indexed by tag per session, and providers by hostname once per run)
 # - Merge all subject-level and file-level metadata from different site sessions into common
 #   data objects that are written to the explorer’s files “guts-file-level-metadata.json”
 #   and “guts-subject-level-metadata.json”:
+#   - records are upserted by natural key (subject+session, provider+file path,
+#     measure short_name), so that the outputs stay complete across runs and
+#     hold every record once; of records with the same key, the one from the
+#     most recently created session (create_ts) wins
 
+# 4: Derive
+# ---------
+# - Build the outputs that the API would otherwise compute at request time:
+#   record hashes (for changes between versions), the availability matrix and
+#   its aggregate table, the search index of the measure overview, and the
+#   compressed and binary (MessagePack, CBOR) encodings of the metadata files.
+# - Outputs whose inputs have the same content hash as in the previous
+#   snapshot are carried over instead of rebuilt.
+
+# 5: Publish
+# ----------
+# - Atomically make the new snapshot the current one, unless its files are
+#   identical to those of the current snapshot, and save the store.
+
+import json
 from pathlib import Path
 import sys
-from datetime import datetime, timezone
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
 
 from utils import (
-    load_json_from_file,
     write_json_to_file,
 )
 
-from neptune_utils import get_metadata
+from cache_utils import serialize_json
+from config import Config
+from neptune_utils import (
+    get_metadata,
+    neptune_client,
+    stream_metadata,
+)
+from matrix_utils import AvailabilityMatrix
+from pipeline_utils import (
+    Derivation,
+    Pipeline,
+    derive,
+    write_encodings,
+)
+from search_utils import build_search_tables
+from snapshot_utils import SnapshotWriter
+from stats_utils import StatsCube
+from sync_utils import (
+    FILE_LEVEL,
+    MEASURE_OVERVIEW,
+    SUBJECT_LEVEL,
+    MetadataStore,
+    hashes_file,
+    keyed_contributions,
+    record_hashes,
+)
 
 
 
@@ -69,13 +125,25 @@ from neptune_utils import get_metadata
 # ---------
 repo_path = Path(__file__).resolve().parent.parent
 _sesspath = repo_path / "data" / "_sessions.json"
-_friendly_providerpath = repo_path / "data" / "_providers_friendly.json"
-_providerpath = repo_path / "data" / "_providers.json"
-_projectpath = repo_path / "data" / "_projects.json"
-_datauserpath = repo_path / "data" / "_data_users.json"
-file_metadata_path = repo_path / "data" / "guts-file-level-metadata.json"
-subject_metadata_path = repo_path / "data" / "guts-subject-level-metadata.json"
-overview_metadata_path = repo_path / "data" / "guts-measure-overview.json"
+_storepath = repo_path / "data" / "_metadata_store.json"
+_snapshotpath = repo_path / Config.METADATA_SNAPSHOT_DIR
+# Files published in each metadata snapshot
+_friendly_providerfile = "_providers_friendly.json"
+_providerfile = "_providers.json"
+_projectfile = "_projects.json"
+_datauserfile = "_data_users.json"
+file_metadata_file = "guts-file-level-metadata.json"
+subject_metadata_file = "guts-subject-level-metadata.json"
+overview_metadata_file = "guts-measure-overview.json"
+availability_file = "guts-subject-availability.npz"
+stats_file = "guts-subject-stats.npz"
+search_index_file = "guts-measure-search-index.json"
+# Merged metadata files per metadata type
+metadata_files = {
+    FILE_LEVEL: file_metadata_file,
+    SUBJECT_LEVEL: subject_metadata_file,
+    MEASURE_OVERVIEW: overview_metadata_file,
+}
 known_meta_types = [
     "file-level-metadata",
     "subject-level-metadata",
@@ -92,52 +160,170 @@ temp_provider_mapping = {
 }
 temp_provider_friendly_names = list(temp_provider_mapping.keys())
 
+# Wall-clock time of each Neptune endpoint fetched by this run
+fetch_timings = {}
+
 
 
 # ---------
 # FUNCTIONS
 # ---------
 
-def add_latest_to_sessions(previous_sessions, latest_session):
-    previous_sessions.append(
-        {
-            "_id": latest_session["_id"],
-            "create_ts": latest_session["create_ts"],
-            "updated": datetime.now(timezone.utc).isoformat(timespec="milliseconds")
-        }
-    )
-    write_json_to_file(previous_sessions, _sesspath)
+def timed_get_metadata(endpoint, params=None):
+    start = time.perf_counter()
+    try:
+        return get_metadata(endpoint, params)
+    finally:
+        fetch_timings[endpoint] = time.perf_counter() - start
+
+
+def session_contributions(s, providers_by_hostname):
+    """Return the provider of a session and the metadata records shared in its
+    events, per metadata type.
+
+    Sessions > events > metadata
+    """
+    # Profiles of the session by tag (the first profile with a tag wins)
+    profiles = {}
+    for p in s["profiles"]:
+        profiles.setdefault(p["tag"], p)
+    provider = None
+    contributions = {}
+    for e in s["events"]:
+        # Event operation must be type share
+        if e["operation"] != "share":
+            continue
+        # Metadata must be an array with more than 0 elements
+        if e.get("metadata", None) is not None and len(e["metadata"]) == 0:
+            continue
+        # To map records to providers, we first need several details
+        # - Get associated profile tag: tag = sessions[i]["events"][j]["profile_tags"]["path"]
+        # - Find associated profile: sessions[i]["profiles"][k]["tag"] == tag
+        profile = profiles[e["profile_tags"]["path"]]
+        # - Get associated hostname: hostname = sessions[i]["events"][j]["profiles"][k]["endpoint"]["hostname"]
+        hostname = profile["endpoint"]["hostname"].strip()
+        # - Get associated friendly name from known list: providers["hostname"] == hostname
+        provider = providers_by_hostname[hostname]["friendly_name"]
+        # Process metadata
+        for m in e["metadata"]:
+            # Metadata item must be of known types:
+            # - m[0] must be "json"
+            # - m[1] must be a string containing one element of ["file-level-metadata", "subject-level-metadata", "measure-overview"]
+            # - m[2] must be an array with more than 0 elements
+            if m[0] != "json" or not any(t in m[1] for t in known_meta_types) or len(m[2]) == 0:
+                continue
+            if "file-level-metadata" in m[1]:
+                for nfm in m[2]:
+                    nfm["explorer_provider"] = provider
+                contributions.setdefault("file-level-metadata", []).extend(m[2])
+            if "subject-level-metadata" in m[1]:
+                contributions.setdefault("subject-level-metadata", []).extend(m[2])
+            # Only add overview metadata if available AND the provider == "eur"
+            if "measure-overview" in m[1] and provider == "eur":
+                contributions["measure-overview"] = m[2]
+    # Assuming only a single provider per session
+    # - if this is not true, the following will take the last provider in a session as the value, incorrectly
+    return provider, contributions
+
+
+def fetch_endpoints(endpoints, dependent={}, max_workers=4):
+    """Fetch Neptune endpoints concurrently, with bounded parallelism.
+
+    'dependent' maps an endpoint to (endpoint it depends on, function returning
+    request params from that endpoint's response); it is submitted as soon as
+    the response it depends on is available.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(timed_get_metadata, e): e for e in endpoints}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                endpoint = futures.pop(future)
+                try:
+                    results[endpoint] = future.result()
+                except Exception as e:
+                    print(f"Failed to get '{endpoint}': {e}")
+                    raise
+                for dep_endpoint, (required, make_params) in dependent.items():
+                    if required == endpoint:
+                        params = make_params(results[endpoint])
+                        futures[executor.submit(timed_get_metadata, dep_endpoint, params)] = dep_endpoint
+    return results
+
+
+def derive_record_hashes(meta_type):
+    """Per-record content hashes of a metadata file, so that the API can serve
+    the changes between snapshot versions."""
+    name = metadata_files[meta_type]
+
+    def build(snapshot, load):
+        write_json_to_file(record_hashes(meta_type, load(name)), snapshot.path(hashes_file(name)))
+        return [hashes_file(name)]
+    return Derivation(f"record-hashes:{meta_type}", [name], build)
+
+
+def derive_availability(snapshot, load):
+    """Columnar availability matrix (subject-sessions x measures) and its
+    aggregate cube, for the subjects and stats endpoints."""
+    matrix = AvailabilityMatrix.from_records(load(subject_metadata_file))
+    matrix.save(snapshot.path(availability_file))
+    StatsCube(matrix).save(snapshot.path(stats_file))
+    return [availability_file, stats_file]
+
+
+def derive_search_index(snapshot, load):
+    """Tables of the full-text search index of the measure overview."""
+    with open(snapshot.path(search_index_file), 'wb') as f:
+        f.write(serialize_json(build_search_tables(load(overview_metadata_file))))
+    return [search_index_file]
+
+
+def derive_encodings(name):
+    """Compressed and binary encodings of a metadata file, served by the API as they are."""
+    return Derivation(f"encodings:{name}", [name], lambda snapshot, load: write_encodings(snapshot, name, load(name)))
+
+
+# Outputs derived from the merged metadata in every snapshot
+derivations = [
+    derive_record_hashes(FILE_LEVEL),
+    derive_record_hashes(SUBJECT_LEVEL),
+    derive_record_hashes(MEASURE_OVERVIEW),
+    Derivation("availability", [subject_metadata_file], derive_availability),
+    Derivation("search-index", [overview_metadata_file], derive_search_index),
+    derive_encodings(file_metadata_file),
+    derive_encodings(subject_metadata_file),
+    derive_encodings(overview_metadata_file),
+]
 
 
 
 # ------
 # SCRIPT
 # ------
-
-# Get own user info
-print("Getting own user info...")
-user_me = get_metadata("users/me")
-# print(f"\tMy provider-id: {user_me['provider_id']}")
-
-# Get data users
-print("Getting data users...")
-data_users = get_metadata("data_users")
-# print(f"\tData users: {data_users}")
-
-# Get projects
-print("Getting projects...")
-projects = get_metadata("projects")
-# print(f"\tProjects: {projects}")
-
-
-# (1) Get providers
-# -----------------
-# Make an HTTP GET request to the "providers" endpoint, retrieving the list.
-print("Getting providers from Neptune endpoint...")
-try:
-    providers = get_metadata("providers")
-except Exception as e:
-    print(e)
+pipeline = Pipeline(["fetch", "filter", "merge", "derive", "publish"])
+
+# (1) Fetch reference data and providers
+# --------------------------------------
+# Make HTTP GET requests to the "users/me", "projects" and "providers" endpoints
+# concurrently; "data_users" needs the provider id from "users/me",
+# so it is requested as soon as that response is in.
+print("Getting own user info, data users, projects and providers from Neptune...")
+with pipeline.stage("fetch"):
+    fetched = fetch_endpoints(
+        ["users/me", "projects", "providers"],
+        dependent={
+            "data_users": ("users/me", lambda user_me: {"provider_id": user_me["provider_id"]}),
+        },
+        max_workers=Config.NEPTUNE_FETCH_WORKERS,
+    )
+user_me = fetched["users/me"]
+data_users = fetched["data_users"]
+projects = fetched["projects"]
+providers = fetched["providers"]
+print(f"Fetched {len(fetched)} endpoints in {pipeline.timings['fetch']:.3f}s:")
+for endpoint, seconds in fetch_timings.items():
+    print(f"\t{endpoint}: {seconds:.3f}s")
 
 # Isolate providers with known friendly names: providers[i]["friendly_name"]
 # - assuming these all have a single endpoint [!]
@@ -154,142 +340,134 @@ friendly_providers = [
 ]
 print("Friendly providers:")
 print(f"\t{friendly_providers}")
-     
-
-# (2) Get and filter sessions
-# ---------------------------
-print("Getting sessions from Neptune endpoint...")
-# Make an HTTP GET request to the "sessions" endpoint, retrieving the list.
-sessions = get_metadata("session")
-# Retrieve list of previously used sessions and their ids
-try:
-    existing_sessions = load_json_from_file(_sesspath)        
-except:
-    existing_sessions = []
-
-existing_session_ids = [s["_id"] for s in existing_sessions]
-# Isolate new and valid sessions
-new_sessions = [
-    s for s in sessions if
-    # New id, i.e. not in list of previously processed ids
-    s["_id"] not in existing_session_ids and
-    # TEMPORARY: Not in list of ids to ignore
-    s["_id"] not in ignore_ids and
-    # Active status
-    s["status"] == "active" and
-    # has at least 1 event, which contains metadata
-    len(s["events"]) > 0
-]
-# Exit process if no new sessions available
-if len(new_sessions) == 0:
-    sys.exit(f"No new active sessions found, exiting process.")
-
-# print(f"\t{new_sessions}")
-
-
-
-# (3) Merge and save metadata
-# ---------------------------
-available_providers = []
-file_metadata = []
-subject_metadata = []
-overview_metadata = []
-file_metadata_added = False
-subject_metadata_added = False
-overview_metadata_added = False
-# Sessions > events > metadata
-for s in new_sessions:
-    metadata_added = False
-    new_ses = {
-        "_id": None,
-        "create_ts": None,
-        "provider": None,
-        "metadata_shared": []
-    }
-    for e in s["events"]:
-        # Event operation must be type share
-        if e["operation"] != "share":
+# Friendly providers by hostname (the first provider with a hostname wins)
+providers_by_hostname = {}
+for fp in friendly_providers:
+    providers_by_hostname.setdefault(fp["hostname"], fp)
+
+
+# (2) Stream and filter sessions, (3) merge their metadata
+# --------------------------------------------------------
+# Make an HTTP GET request to the "session" endpoint and process the sessions
+# one by one while the response is being downloaded, so that the response is
+# never held in memory as a whole (the store does keep all merged records in
+# memory, see MetadataStore). Time spent downloading and parsing the stream
+# counts towards the fetch stage.
+print("Streaming sessions from Neptune endpoint...")
+# Load the store of previously merged sessions and their metadata
+store = MetadataStore.load(_storepath)
+n_sessions = 0
+n_new_sessions = 0
+# Sessions in the stream, to find merged sessions that were deleted from Neptune
+seen_ids = set()
+for s in pipeline.timed("fetch", stream_metadata("session")):
+    n_sessions += 1
+    seen_ids.add(s["_id"])
+    with pipeline.stage("filter"):
+        # Sessions that were merged before but are no longer active: drop their metadata
+        if s["status"] != "active":
+            if s["_id"] in store.sessions:
+                print(f"Removing metadata of inactive session {s['_id']}")
+                store.remove_session(s["_id"])
             continue
-        # Metadata must be an array with more than 0 elements
-        if e.get("metadata", None) is not None and len(e["metadata"]) == 0:
+        if store.is_processed(s):
             continue
-        # Process metadata
-        for m in e["metadata"]:
-            # To write the new session ids and friendly names and time stamps to "previously processed"
-            # list, and also to map files to providers, we first need several details
-
-            # - Get id and time stamp directly from session
-            new_ses["_id"] = s["_id"]
-            new_ses["create_ts"] = s["create_ts"]
-            # - Get associated profile tag: tag = sessions[i]["events"][j]["profile_tags"]["path"]
-            profile_tag = e["profile_tags"]["path"]
-            # - Find associated profile: k where sessions[i]["events"][j]["profiles"][k]["tag"] == tag
-            profiles = [p for p in s["profiles"] if p["tag"] == profile_tag]
-            profile = profiles[0]
-            # - Get associated hostname: hostname = sessions[i]["events"][j]["profiles"][k]["endpoint"]["hostname"]
-            hostname = profile["endpoint"]["hostname"].strip()
-            print(hostname)
-            # - Get associated friendly name from known list: providers["hostname"] == hostname
-            pproviders = [fp for fp in friendly_providers if fp["hostname"] == hostname]
-            provider = pproviders[0]
-            new_ses["provider"] = provider["friendly_name"]
-            if new_ses["provider"] not in available_providers:
-                available_providers.append(new_ses["provider"])
-            
-            # Now process metadata
-            # Metadata item must be of known types:
-            # - m[0] must be "json"
-            # - m[1] must be a string containing one element of ["file-level-metadata", "subject-level-metadata", "measure-overview"]
-            # - m[2] must be an array with more than 0 elements
-            if m[0] != "json" or not any(t in m[1] for t in known_meta_types) or len(m[2]) == 0:
-                continue
-            if "file-level-metadata" in m[1]:
-                new_file_metadata = [f for f in m[2]]
-                for nfm in new_file_metadata:
-                    nfm["explorer_provider"] = new_ses["provider"]
-                file_metadata += new_file_metadata
-                file_metadata_added = True
-                if "file-level-metadata" not in new_ses["metadata_shared"]:
-                    new_ses["metadata_shared"].append("file-level-metadata")
-            if "subject-level-metadata" in m[1]:
-                subject_metadata += m[2]
-                subject_metadata_added = True
-                if "subject-level-metadata" not in new_ses["metadata_shared"]:
-                    new_ses["metadata_shared"].append("subject-level-metadata")
-            # Only add overview metadata if available AND the provider == "eur"
-            if "measure-overview" in m[1] and new_ses["provider"] == "eur":
-                overview_metadata = m[2]
-                overview_metadata_added = True
-                if "measure-overview" not in new_ses["metadata_shared"]:
-                    new_ses["metadata_shared"].append("measure-overview")
-            metadata_added = file_metadata_added or subject_metadata_added or overview_metadata_added
-    # Assuming only a single provider per session
-    # - if this is not true, the following will take the last provider in a session as the value, incorrectly
-    if metadata_added:
-        existing_sessions.append(new_ses)
-
-# (4) Write files
-# ---------------
-write_json_to_file(friendly_providers, _friendly_providerpath)
-write_json_to_file(providers, _providerpath)
-write_json_to_file(data_users, _datauserpath)
-write_json_to_file(projects, _projectpath)
-
-if file_metadata_added:
-    write_json_to_file(file_metadata, file_metadata_path)
-if subject_metadata_added:
-    write_json_to_file(subject_metadata, subject_metadata_path)
-if overview_metadata_added:
-    write_json_to_file(overview_metadata, overview_metadata_path)
-if file_metadata_added or subject_metadata_added or overview_metadata_added:
-    write_json_to_file(existing_sessions, _sesspath)
-
-
-if not file_metadata_added and not subject_metadata_added and not overview_metadata_added:
+        # Skip sessions that are ignored or without events (dropping what they contributed before)
+        if s["_id"] in ignore_ids or len(s["events"]) == 0:
+            store.remove_session(s["_id"])
+            continue
+    # The store resolves conflicts by create_ts, so sessions can be merged in any order
+    with pipeline.stage("merge"):
+        provider, contributions = session_contributions(s, providers_by_hostname)
+        if contributions:
+            store.add_session(s, provider, keyed_contributions(contributions))
+            n_new_sessions += 1
+        else:
+            # A changed session may no longer contribute what it did before
+            store.remove_session(s["_id"])
+for session_id in set(store.sessions) - seen_ids:
+    print(f"Removing metadata of deleted session {session_id}")
+    store.remove_session(session_id)
+print(f"Merged {n_new_sessions} new or changed session(s) out of {n_sessions}")
+# Exit process if no new sessions and nothing was removed
+if not store.changed:
+    for name in ["merge", "derive", "publish"]:
+        pipeline.skip(name, "no new or changed sessions")
+    pipeline.report()
+    sys.exit(f"No new active sessions found, exiting process.")
+
+# All outputs are written to a new snapshot directory, which atomically
+# becomes the current one once it is complete. Outputs that did not change
+# are carried over from the previous snapshot (or, for the first snapshot,
+# from the data directory).
+snapshot = SnapshotWriter(_snapshotpath)
+# Merged metadata written by this run, by file name
+merged = {}
+
+
+def load_merged(name):
+    """Merged metadata of a file in the snapshot, read from it if it was carried over."""
+    if name not in merged:
+        with open(snapshot.path(name), 'r', encoding='utf-8') as f:
+            merged[name] = json.load(f)
+    return merged[name]
+
+
+try:
+    with pipeline.stage("merge"):
+        for data, name in [
+            (friendly_providers, _friendly_providerfile),
+            (providers, _providerfile),
+            (data_users, _datauserfile),
+            (projects, _projectfile),
+        ]:
+            write_json_to_file(data, snapshot.path(name))
+            snapshot.add(name)
+        for meta_type, name in metadata_files.items():
+            if meta_type in store.changed:
+                merged[name] = store.output(meta_type)
+                write_json_to_file(merged[name], snapshot.path(name))
+                snapshot.add(name)
+            else:
+                snapshot.carry_over(name, fallback=repo_path / "data" / name)
+
+    # (4) Derive
+    # ----------
+    # Outputs are rebuilt only if the content of their inputs changed
+    print("Deriving outputs...")
+    with pipeline.stage("derive"):
+        built = derive(snapshot, derivations, load_merged)
+    if not built:
+        pipeline.skip("derive", "inputs unchanged")
+
+    # (5) Publish
+    # -----------
+    with pipeline.stage("publish"):
+        if snapshot.unchanged():
+            snapshot.discard()
+            pipeline.skip("publish", "identical to the current snapshot")
+            print(f"Metadata is identical to snapshot {snapshot.previous.version}, not publishing")
+        else:
+            snapshot_path = snapshot.publish(retention=Config.METADATA_SNAPSHOT_RETENTION)
+            print(f"Published metadata snapshot {snapshot.version} to {snapshot_path}")
+        store.save(_storepath)
+        write_json_to_file(store.processed_sessions(), _sesspath)
+except Exception:
+    snapshot.discard()
+    raise
+
+
+if not store.changed:
     print(f"WARNING: No file-level, subject-level, or overview metadata available from any share-sessions.")
 else:
-    if len(available_providers) < 2:
-        print(f"WARNING: Active session(s) only from {len(available_providers)} provider, i.e. request creation to several providers cannot be tested.")
+    print(f"Updated metadata: {', '.join(sorted(store.changed))}")
+    if len(store.providers()) < 2:
+        print(f"WARNING: Active session(s) only from {len(store.providers())} provider, i.e. request creation to several providers cannot be tested.")
+
+pipeline.report()
+print("Neptune request latency:")
+for name, m in neptune_client.metrics().items():
+    print(f"\t{name}: {m['count']} request(s), mean {m['mean_seconds']:.3f}s, max {m['max_seconds']:.3f}s")
 
 print("Process of updating metadata completed.")
 
@@ -1,7 +1,14 @@
 import json
+import re
 from datetime import datetime
 from flask import abort
 
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Characters that can follow a complete element of a JSON array
+ELEMENT_END = ' \t\n\r,]'
+# The delimiter after an element of a JSON array, with the surrounding whitespace
+DELIMITER = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
 # Functions
 def sort_by_datetime(items, dt_key):
     return sorted(items, key=lambda x: datetime.fromisoformat(x[dt_key]), reverse=True)
@@ -15,6 +22,120 @@ def load_json_from_file(file_path):
     except json.JSONDecodeError:
         abort(500, description="Error decoding metadata file.")
 
+def iter_json_array(chunks):
+    """Incrementally parse a JSON array from an iterable of text chunks,
+    yielding its elements one by one.
+
+    Only the element being parsed (plus one chunk) is kept in memory, so
+    arbitrarily long arrays can be processed with bounded memory.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+    pending = []
+    pending_size = 0
+    eof = False
+
+    def read():
+        nonlocal pending_size, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            pending.append(chunk)
+            pending_size += len(chunk)
+
+    def flush():
+        """Append the pending chunks to the buffer, dropping its parsed part.
+        Between chunks, elements are parsed in place at the read offset."""
+        nonlocal buffer, pos, pending_size
+        if not pending:
+            return
+        buffer = buffer[pos:] + ''.join(pending)
+        pos = 0
+        pending.clear()
+        pending_size = 0
+
+    def next_char():
+        """Skip whitespace and return the next character ('' at the end of input)."""
+        nonlocal pos
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof and not pending:
+                return ''
+            while not pending and not eof:
+                read()
+            flush()
+
+    if next_char() != '[':
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    if next_char() == ']':
+        return
+    while True:
+        # Parse the next element, reading more input while it is incomplete.
+        # The amount of buffered input must double between attempts, so that
+        # parsing a large element costs linear rather than quadratic time.
+        required = 0
+        while True:
+            while not eof and len(buffer) - pos + pending_size < required:
+                read()
+            flush()
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                # An element is only complete when whitespace or a delimiter
+                # follows it: a number may continue in the next chunk (e.g.
+                # '1.5' of '1.5e3'), also if it isn't at the very end of the buffer
+                if eof or (end < len(buffer) and buffer[end] in ELEMENT_END):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            required = 2 * (len(buffer) - pos) + 1
+        pos = end
+        yield item
+        # Usually the delimiter and the start of the next element are buffered already
+        match = DELIMITER.match(buffer, pos)
+        if match is not None and match.end() < len(buffer):
+            delimiter = match.group(1)
+            pos = match.end()
+        else:
+            delimiter = next_char()
+            pos += 1
+            if delimiter == ',':
+                next_char()
+        if delimiter == ']':
+            return
+        if delimiter != ',':
+            raise ValueError(f"Expected ',' or ']' in JSON array, found {delimiter!r}")
+
+
+def iter_json_object(document, key, items, batch_size=1000):
+    """Serialize a JSON object whose list value at 'key' is produced lazily,
+    yielding the encoded body in chunks of (up to) batch_size list items.
+
+    Used as a streaming request body, so that a very long list never has to
+    be held in memory as objects or as one serialized string.
+    """
+    head = json.dumps({k: v for k, v in document.items() if k != key})
+    separator = ', ' if head != '{}' else ''
+    yield f"{head[:-1]}{separator}{json.dumps(key)}: [".encode('utf-8')
+    batch = []
+    first = True
+    for item in items:
+        batch.append(json.dumps(item))
+        if len(batch) >= batch_size:
+            yield (('' if first else ', ') + ', '.join(batch)).encode('utf-8')
+            batch = []
+            first = False
+    if batch:
+        yield (('' if first else ', ') + ', '.join(batch)).encode('utf-8')
+    yield b"]}"
+
+
 def write_json_to_file(data, file_path):
     with open(file_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
@@ -29,4 +150,4 @@ def find_element_in_list(arr, key, val, mode='equals'):
     elif len(found_el) == 1:
         return found_el[0]
     else:
-        raise ValueError(f"Multiple elements found in list where 'el[{key}]' {mode} '{val}'")
\ No newline at end of file
+        raise ValueError(f"Multiple elements found in list where 'el[{key}]' {mode} '{val}'")
@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+from werkzeug.exceptions import NotFound
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+# Configuration read when the modules are imported
+os.environ.setdefault("JOB_QUEUE_PATH", os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"))
+os.environ.setdefault("NEPTUNE_CERT_PATH", "neptune.pem")
+
+import neptune_utils  # noqa: E402
+import submit_utils  # noqa: E402
+from job_utils import FAILED, JobQueue, JobWorkers  # noqa: E402
+
+
+@pytest.fixture
+def workers(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite3")
+    return JobWorkers(queue, {submit_utils.DATA_REQUEST: submit_utils.process_data_request})
+
+
+PAYLOAD = {
+    "provider_friendly": "eur",
+    "file_paths": ["sub-1/f.txt"],
+    "user_data": {"email": "user@example.org"},
+    "form_data": {},
+}
+
+
+def run_once(workers):
+    job_id = workers.queue.enqueue(submit_utils.DATA_REQUEST, PAYLOAD, max_attempts=8)
+    workers._process(workers.queue.claim(workers.lease))
+    return workers.queue.get(job_id)
+
+
+@pytest.mark.parametrize("error", [
+    KeyError("p1"),
+    NotFound("Metadata file not found."),
+    ValueError("No provider found with friendly name: x"),
+])
+def test_building_the_session_fails_permanently(workers, monkeypatch, error):
+    def create_neptune_data_request(data):
+        raise error
+    monkeypatch.setattr(submit_utils, "create_neptune_data_request", create_neptune_data_request)
+    job = run_once(workers)
+    assert job["status"] == FAILED
+    assert job["attempts"] == 1
+
+
+def test_missing_reference_files_fail_permanently(workers, monkeypatch, tmp_path):
+    monkeypatch.setattr(neptune_utils, "reference_path", lambda name: tmp_path / name)
+    monkeypatch.setattr(neptune_utils, "_reference_registry", (None, None))
+    job = run_once(workers)
+    assert job["status"] == FAILED
+    assert job["attempts"] == 1
+    assert job["error"].startswith("NotFound")
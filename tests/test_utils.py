@@ -0,0 +1,35 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from utils import iter_json_array  # noqa: E402
+
+ARRAYS = [
+    '[1, 23]',
+    '[1.5e3,-0.25E-2, 10]',
+    '[true,false, null ,"x"]',
+    '[{"a": [1, 23]}, 456789, [], {}]',
+    ' [ ] ',
+]
+
+
+@pytest.mark.parametrize("text", ARRAYS)
+def test_elements_split_at_any_chunk_boundary(text):
+    for i in range(len(text) + 1):
+        assert list(iter_json_array([text[:i], text[i:]])) == json.loads(text), text[:i]
+
+
+@pytest.mark.parametrize("text", ARRAYS)
+def test_single_character_chunks(text):
+    assert list(iter_json_array(iter(text))) == json.loads(text)
+
+
+@pytest.mark.parametrize("text", ['[1 2]', '{"a": 1}', '[1,', '[1.5e]', '[tru]'])
+def test_invalid_arrays(text):
+    for i in range(len(text) + 1):
+        with pytest.raises(ValueError):
+            list(iter_json_array([text[:i], text[i:]]))